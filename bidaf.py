@@ -1,12 +1,16 @@
 import tensorflow as tf
+import numpy as np
 import sys
 
 from tensorflow.contrib.rnn import BasicLSTMCell
 from BiDAF_ops.my.tensorflow.nn import softsel, get_logits, highway_network
+from BiDAF_ops.my.tensorflow.nn import softmax
+from BiDAF_ops.my.tensorflow import exp_mask, add_wd
 from BiDAF_ops.my.tensorflow.rnn import bidirectional_dynamic_rnn
 from BiDAF_ops.my.tensorflow.rnn_cell import SwitchableDropoutWrapper, AttentionCell
 from model import Basic
 from ops import *
+from utils import ContextCache
 
 
 class BiDAF(Basic):
@@ -20,6 +24,9 @@ class BiDAF(Basic):
         self.highway_num_layers = params['highway_num_layers']
         self.hidden_size = params['hidden_size']
         self.load_seo = params['load_seo']
+        self.attention_impl = params['attention_impl']
+        self.context_cache = (ContextCache(params['context_cache'])
+                if params['context_cache'] > 0 else None)
         # Placeholders
         self.is_train = tf.placeholder('bool')
         
@@ -50,9 +57,27 @@ class BiDAF(Basic):
         return h, u
 
     
+    def tri_linear_logits(self, h, u, mask, scope):
+        # get_logits(func='tri_linear') of h [N, M, JX, d] and u [N, JQ, d]
+        # with the same variables, without tiling both to [N, M, JX, JQ, d]
+        with tf.variable_scope(scope):
+            with tf.variable_scope('first'):
+                dim = h.get_shape().as_list()[-1]
+                kernel = tf.get_variable('kernel', [3 * dim, 1])
+                bias = tf.get_variable('bias', [1],
+                        initializer=tf.constant_initializer(0.0))
+            logits = trilinear_similarity(h, u, kernel, bias)
+            if self.wd:
+                add_wd(self.wd)
+            return exp_mask(logits, mask)
+
     def attention_flow_layer(self, h, u, reuse=None):
         if self.load_seo: vs="main"
         else: vs="Attention_Flow_Layer"
+        if self.attention_impl == 'matmul' and self.logit_func == 'tri_linear':
+            with tf.device('/gpu:1'):
+                with tf.variable_scope(vs, reuse=reuse) as scope:
+                    return self.matmul_attention_flow(h, u)
         with tf.device('/gpu:1'):
             with tf.variable_scope(vs, reuse=reuse) as scope:
                 h_mask = self.x_mask
@@ -84,6 +109,27 @@ class BiDAF(Basic):
 
                 p0 = tf.concat(axis=3, values=[h, u_a, h*u_a, h*h_a])
             return p0
+
+    def matmul_attention_flow(self, h, u):
+        # attention_flow_layer with the [N, M, JX, JQ] similarity from
+        # tri_linear_logits and the question attention as a batched matmul
+        N = tf.shape(h)[0]
+        M = tf.shape(h)[1]
+        JX = tf.shape(h)[2]
+        JQ = tf.shape(u)[1]
+        d = h.get_shape().as_list()[-1]
+        hu_mask = tf.logical_and(tf.expand_dims(self.x_mask, 3),
+                tf.expand_dims(tf.expand_dims(self.q_mask, 1), 1))
+        if self.load_seo:
+            with tf.variable_scope("p0/bi_attention"):
+                u_logits = self.tri_linear_logits(h, u, hu_mask, 'u_logits')
+        else:
+            u_logits = self.tri_linear_logits(h, u, hu_mask, 'u_logits')
+        u_a = tf.reshape(tf.matmul(
+            tf.reshape(softmax(u_logits), [N, M * JX, JQ]), u), [N, M, JX, d])
+        h_a = softsel(h, tf.reduce_max(u_logits, 3))  # [N, M, d]
+        h_a = tf.tile(tf.expand_dims(h_a, 2), [1, 1, JX, 1])
+        return tf.concat(axis=3, values=[h, u_a, h*u_a, h*h_a])
     
     def modeling_layer(self, p0, reuse=None):
         if self.load_seo: vs="main"
@@ -208,6 +254,11 @@ class BiDAF(Basic):
                 qq = highway_network(qq, self.highway_num_layers, True, wd=self.wd, is_train=self.is_train)
  
         H, U = self.contextual_embedding_layer(xx, qq)
+        # H depends only on the context; feeding context_encoding_input
+        # skips the context highway and RNN (see cached_logits)
+        self.context_encoding = H
+        H = self.context_encoding_input = tf.placeholder_with_default(
+                H, H.get_shape(), name='context_encoding_input')
         print('# Contextual_Embedding_layer', H, U)
         #H = tf.Print(H, [H], "H : ")
         G = self.attention_flow_layer(H, U)
@@ -224,4 +275,37 @@ class BiDAF(Basic):
         print(tf.trainable_variables())
         self.optimize_loss(self.start_logits, self.end_logits)
 
+    def inference_inputs(self):
+        return super(BiDAF, self).inference_inputs() + ['is_train']
+
+    def cached_logits(self, feed_dict):
+        # Encodes only the contexts missing from the cache, then runs the
+        # question-dependent stages on the cached encodings
+        contexts = feed_dict[self.context]
+        context_lens = feed_dict[self.context_len]
+        keys = [self.context_cache.key(c, c_len) 
+                for c, c_len in zip(contexts, context_lens)]
+        encodings = {}
+        missing = []
+        for idx, key in enumerate(keys):
+            if key in encodings:
+                continue
+            encodings[key] = self.context_cache.get(key)
+            if encodings[key] is None:
+                missing.append(idx)
+
+        if missing:
+            encode_feed = dict(feed_dict)
+            encode_feed[self.context] = contexts[missing]
+            encode_feed[self.context_len] = context_lens[missing]
+            encoded = self.session.run(self.context_encoding, 
+                    feed_dict=encode_feed)
+            for idx, encoding in zip(missing, encoded):
+                encodings[keys[idx]] = encoding
+                self.context_cache.put(keys[idx], encoding)
 
+        feed_dict = dict(feed_dict)
+        feed_dict[self.context_encoding_input] = np.stack(
+                [encodings[key] for key in keys])
+        return self.session.run([self.start_logits, self.end_logits], 
+                feed_dict=feed_dict)
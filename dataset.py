@@ -6,6 +6,10 @@ import datetime
 import string
 import operator
 import collections
+import bisect
+import hashlib
+import shutil
+import multiprocessing
 import numpy as np
 import nltk
 from pycorenlp import StanfordCoreNLP 
@@ -13,6 +17,10 @@ from pycorenlp import StanfordCoreNLP
 nlp = StanfordCoreNLP('http://localhost:9000')
 nltk.download('punkt')
 
+# Bump CACHE_VERSION whenever preprocess() or the cache layout changes
+CACHE_VERSION = 5
+TOKENIZER = 'nltk.word_tokenize+offsets'
+
 
 def read_data(dataset_path, version):
     with open(dataset_path) as dataset_file:
@@ -25,28 +33,67 @@ def read_data(dataset_path, version):
     return dataset
 
 
-def load_glove(dictionary, params):
-    print('Glove Loading...')
+def glove_store_paths(glove_path):
+    prefix = os.path.splitext(glove_path)[0]
+    return prefix + '.vocab', prefix + '.npy'
+
+
+def convert_glove(glove_path, dim_embed_word):
+    # One-time conversion of the glove text file into a vocabulary file and
+    # a float32 matrix that load_glove memory-maps
+    print('Glove Converting...')
     start_time = datetime.datetime.now()
-    glove = {}
-    glove_path = os.path.expanduser(params['glove_path'])
+    vocab_path, matrix_path = glove_store_paths(glove_path)
     with open(glove_path, 'r', encoding='utf-8', errors='ignore') as f:
-        while True:
+        line_cnt = sum(1 for _ in f)
+        tmp_matrix_path = matrix_path + '.tmp.npy'
+        matrix = np.lib.format.open_memmap(tmp_matrix_path, mode='w+',
+                dtype=np.float32, shape=(line_cnt, dim_embed_word))
+        f.seek(0)
+        words = []
+        for line in f:
+            parts = line.rstrip().split(' ')
+            if len(parts) != dim_embed_word + 1:
+                print('Glove skipped line', len(words), parts[0])
+                continue
             try:
-                line = f.readline()
-                if not line: break
-                word = line.split()[0]
-                embed = [float(l) for l in line.split()[1:]]
-                glove[word] = embed
+                matrix[len(words)] = np.array(parts[1:], dtype=np.float32)
             except ValueError as e:
                 print(e)
-                
+                continue
+            words.append(parts[0])
+        matrix.flush()
+        del matrix
+
+    # Rows past len(words) belong to skipped lines and are never read
+    with open(vocab_path + '.tmp', 'w', encoding='utf-8') as f:
+        f.write('\n'.join(words))
+    os.rename(tmp_matrix_path, matrix_path)
+    os.rename(vocab_path + '.tmp', vocab_path)
+
+    elapsed_time = datetime.datetime.now() - start_time
+    print('Glove Converting Done', elapsed_time, len(words))
+
+
+def load_glove(dictionary, params):
+    print('Glove Loading...')
+    start_time = datetime.datetime.now()
+    glove_path = os.path.expanduser(params['glove_path'])
+    vocab_path, matrix_path = glove_store_paths(glove_path)
+    if not (os.path.exists(vocab_path) and os.path.exists(matrix_path)):
+        convert_glove(glove_path, params['dim_embed_word'])
+
+    # Later duplicates win, as they did with the text parser
+    with open(vocab_path, 'r', encoding='utf-8') as f:
+        glove = {word: row for row, word in enumerate(f.read().split('\n'))
+                if word in dictionary}
+    glove_matrix = np.load(matrix_path, mmap_mode='r')
     elapsed_time = datetime.datetime.now() - start_time
-    print('Glove Loading Done', elapsed_time, len(glove))
+    print('Glove Loading Done', elapsed_time, glove_matrix.shape)
 
-    pretrained_vectors = []
     word2idx = {}
     idx2word = {}
+    glove_rows = []
     unk_cnt = 0
     np.random.seed(253)
     unknown_vector = np.random.uniform(-1, 1, params['dim_embed_word'])
@@ -54,20 +101,24 @@ def load_glove(dictionary, params):
     word2idx['PAD'] = len(word2idx)
     idx2word[0] = 'UNK'
     idx2word[1] = 'PAD'
-    pretrained_vectors.append(unknown_vector)
-    pretrained_vectors.append([0.0] * params['dim_embed_word'])
     for word, word_idx in sorted(dictionary.items(), key=operator.itemgetter(1)):
         if word in glove:
             word2idx[word] = len(word2idx)
             idx2word[len(word2idx)-1] = word
-            pretrained_vectors.append(glove[word])
+            glove_rows.append(glove[word])
         else:
             unk_cnt += 1
 
-    print('apple:', word2idx['apple'], glove['apple'][:5])
-    print('Pretrained vectors', np.asarray(pretrained_vectors).shape, 'unk', unk_cnt)
+    # Only the rows of dictionary words are read from the memory-mapped matrix
+    pretrained_vectors = np.zeros(
+            [len(word2idx), params['dim_embed_word']], dtype=np.float32)
+    pretrained_vectors[0] = unknown_vector
+    pretrained_vectors[2:] = glove_matrix[np.array(glove_rows, dtype=np.int64)]
+
+    print('apple:', word2idx['apple'], pretrained_vectors[word2idx['apple']][:5])
+    print('Pretrained vectors', pretrained_vectors.shape, 'unk', unk_cnt)
     print('Dictionary Change', len(dictionary), 'to', len(word2idx), len(idx2word))
-    return np.asarray(pretrained_vectors).astype(np.float32), word2idx, idx2word 
+    return pretrained_vectors, word2idx, idx2word 
 
 
 def tokenize_corenlp(words):
@@ -77,15 +128,61 @@ def tokenize_corenlp(words):
     return result    
 
 
+def normalize_token(token):
+    return token.replace("''", '"').replace("``", '"').lower()
+
+
 def tokenize(words):
-    result = [token.replace("''", '"').replace("``", '"').lower() 
-            for token in nltk.word_tokenize(words)]
+    result = [normalize_token(token) for token in nltk.word_tokenize(words)]
     return result
 
 
+def tokenize_with_offsets(words):
+    # nltk rewrites double quotes, so those tokens are matched against every
+    # quote form that may appear in the raw text
+    tokens = nltk.word_tokenize(words)
+    starts = []
+    ends = []
+    cursor = 0
+    for token in tokens:
+        if token in ('``', "''", '"'):
+            candidates = [(words.find(q, cursor), q) for q in ('``', "''", '"')]
+            candidates = [c for c in candidates if c[0] >= 0]
+            start, matched = min(candidates) if candidates else (-1, token)
+        else:
+            start, matched = words.find(token, cursor), token
+        if start >= 0:
+            cursor = start + len(matched)
+        else:
+            start = cursor
+        starts.append(start)
+        ends.append(cursor)
+    return [normalize_token(token) for token in tokens], starts, ends
+
+
+def tokenize_paragraph(paragraph):
+    # Each context and question is tokenized once per run; build_dict and
+    # preprocess share the result through these keys
+    if 'c_tokens' not in paragraph:
+        (paragraph['c_tokens'], paragraph['c_starts'],
+                paragraph['c_ends']) = tokenize_with_offsets(paragraph['context'])
+        for qa in paragraph['qas']:
+            qa['q_tokens'] = tokenize(qa['question'])
+    return paragraph
+
+
+def answer_span(paragraph, answer_start, answer_text):
+    # Token indices of the first and last tokens overlapping the answer
+    starts = paragraph['c_starts']
+    ends = paragraph['c_ends']
+    a_start = bisect.bisect_right(ends, answer_start)
+    a_end = bisect.bisect_left(starts, answer_start + len(answer_text)) - 1
+    return a_start, max(a_start, a_end)
+
+
 def word2idx(words, dictionary, max_length=None):
     result_idx = []
-    for word in tokenize(words):
+    for word in words:
         if word not in dictionary:
             result_idx.append(dictionary['UNK'])
         else:
@@ -149,27 +246,30 @@ def char2cnt(word_list, counter):
                 counter[char] += 1
 
 
-def build_dict(dataset, params):
-    dictionary = {}
-    reverse_dictionary = {}
+def map_articles(func, dataset, num_workers, *args):
+    # Contiguous shards keep the merged output in serial order
+    if num_workers <= 1:
+        return [func(dataset, *args)]
+    articles = list(dataset)
+    shard_size = (len(articles) + num_workers - 1) // num_workers
+    shards = [(articles[i:i+shard_size],) + args
+            for i in range(0, len(articles), shard_size)]
+    with multiprocessing.Pool(num_workers) as pool:
+        return pool.starmap(func, shards)
+
+
+def count_articles(dataset):
     counter = {}
+    char_counter = {}
     context_maxlen = 0
     question_maxlen = 0
     answer_maxlen = 0
-    
-    char_dict = {}
-    reverse_char_dict = {}
     word_maxlen = 0
-    char_counter = {}
-    char_dict['UNK'] = 0
-    char_dict['PAD'] = 1
-    reverse_char_dict[0] = 'UNK'
-    reverse_char_dict[1] = 'PAD'
-    
+
     for d_idx, document in enumerate(dataset):
         for p_idx, paragraph in enumerate(document['paragraphs']):
-            context = paragraph['context']
-            context_words = tokenize(context)
+            tokenize_paragraph(paragraph)
+            context_words = paragraph['c_tokens']
             c_char = [list(word) for word in context_words]
 	    
             word2cnt(context_words, counter)
@@ -184,9 +284,8 @@ def build_dict(dataset, params):
 
 
             for qa in paragraph['qas']:
-                question = qa['question']
                 answers = qa['answers']
-                question_words = tokenize(question)
+                question_words = qa['q_tokens']
                 q_char = [list(word) for word in question_words]
                 
                 word2cnt(question_words, counter)
@@ -196,6 +295,8 @@ def build_dict(dataset, params):
                     question_maxlen = len(question_words)
 
                 for answer in answers:
+                    # Answer texts are tokenized on their own, as before, so
+                    # the vocabulary matches existing checkpoints
                     answer_words = tokenize(answer['text'])
                     word2cnt(answer_words, counter)
                     if len(answer_words) > answer_maxlen:
@@ -205,6 +306,51 @@ def build_dict(dataset, params):
                     if len(word) > word_maxlen:
                         word_maxlen = len(word)
 
+
+    tokenized = [[(paragraph['c_tokens'], paragraph['c_starts'],
+        paragraph['c_ends'], [qa['q_tokens'] for qa in paragraph['qas']])
+        for paragraph in document['paragraphs']] for document in dataset]
+    return (tokenized, counter, char_counter, 
+            context_maxlen, question_maxlen, answer_maxlen, word_maxlen)
+
+
+def build_dict(dataset, params):
+    dictionary = {}
+    reverse_dictionary = {}
+    counter = {}
+    context_maxlen = 0
+    question_maxlen = 0
+    answer_maxlen = 0
+    
+    char_dict = {}
+    reverse_char_dict = {}
+    word_maxlen = 0
+    char_counter = {}
+    char_dict['UNK'] = 0
+    char_dict['PAD'] = 1
+    reverse_char_dict[0] = 'UNK'
+    reverse_char_dict[1] = 'PAD'
+
+    # Merge shards in order, so counters keep the serial insertion order
+    documents = iter(dataset)
+    for (tokenized, s_counter, s_char_counter, s_c_maxlen, s_q_maxlen, 
+            s_a_maxlen, s_w_maxlen) in map_articles(
+                    count_articles, dataset, params['preprocess_workers']):
+        for s_document, document in zip(tokenized, documents):
+            for s_paragraph, paragraph in zip(s_document, document['paragraphs']):
+                (paragraph['c_tokens'], paragraph['c_starts'],
+                        paragraph['c_ends'], q_tokens) = s_paragraph
+                for qa, tokens in zip(paragraph['qas'], q_tokens):
+                    qa['q_tokens'] = tokens
+        for key, value in s_counter.items():
+            counter[key] = counter.get(key, 0) + value
+        for key, value in s_char_counter.items():
+            char_counter[key] = char_counter.get(key, 0) + value
+        context_maxlen = max(context_maxlen, s_c_maxlen)
+        question_maxlen = max(question_maxlen, s_q_maxlen)
+        answer_maxlen = max(answer_maxlen, s_a_maxlen)
+        word_maxlen = max(word_maxlen, s_w_maxlen)
+
     print('Top 20 frequent words among', len(counter))
     print([(k, counter[k]) for k in sorted(
         counter, key=counter.get, reverse=True)[:20]])
@@ -246,23 +392,153 @@ def build_dict(dataset, params):
             question_maxlen, word_maxlen, char_dict, reverse_char_dict)
 
 
-def preprocess(dataset, dictionary, c_maxlen, q_maxlen, w_maxlen, char_dictionary):
+class SquadDataset(object):
+    """Struct-of-arrays view of a preprocessed SQuAD split.
+
+    Paragraph arrays (c, c_len, c_tok) are indexed by paragraph, question
+    arrays (q, q_len, q_tok, a_start, a_end) by question, and q_par maps each
+    question to its paragraph. c_tok and q_tok index the token table, which
+    holds one row of char ids per distinct token (row 0 is padding). Raw
+    tokens and strings are kept in plain lists next to the arrays.
+    """
+    paragraph_fields = ['c', 'c_len', 'c_tok']
+    question_fields = ['q', 'q_len', 'q_tok', 'a_start', 'a_end', 'q_par']
+    table_fields = ['token_char', 'token_char_len']
+    raw_fields = ['tokens', 'c_raw', 'c_real', 'q_raw', 'answers', 'ids']
+
+    def __init__(self, **fields):
+        for key in (self.paragraph_fields + self.question_fields
+                + self.table_fields + self.raw_fields):
+            setattr(self, key, fields[key])
+
+    def __len__(self):
+        return len(self.q)
+
+    @property
+    def num_paragraphs(self):
+        return len(self.c)
+
+    @classmethod
+    def from_items(cls, cqa_set, char_dictionary, w_maxlen):
+        qas = [qa for item in cqa_set for qa in item['qa']]
+        tokens = ['']
+        token_dict = {'': 0}
+
+        def token_ids(words, max_length):
+            ids = np.zeros(max_length, dtype=np.int32)
+            for w_idx, word in enumerate(words[:max_length]):
+                if word not in token_dict:
+                    token_dict[word] = len(tokens)
+                    tokens.append(word)
+                ids[w_idx] = token_dict[word]
+            return ids
+
+        fields = {}
+        fields['c'] = np.array([item['c'] for item in cqa_set], dtype=np.int32)
+        fields['c_len'] = np.array(
+                [item['c_len'] for item in cqa_set], dtype=np.int32)
+        fields['c_tok'] = np.array([token_ids(item['c_raw'], len(item['c']))
+            for item in cqa_set], dtype=np.int32)
+        fields['q'] = np.array([qa['q'] for qa in qas], dtype=np.int32)
+        fields['q_len'] = np.array([qa['q_len'] for qa in qas], dtype=np.int32)
+        fields['q_tok'] = np.array([token_ids(qa['q_raw'], len(qa['q']))
+            for qa in qas], dtype=np.int32)
+        fields['a_start'] = np.array(
+                [qa['a_start'] for qa in qas], dtype=np.int32)
+        fields['a_end'] = np.array([qa['a_end'] for qa in qas], dtype=np.int32)
+        fields['q_par'] = np.array([p_idx for p_idx, item in enumerate(cqa_set)
+            for _ in item['qa']], dtype=np.int32)
+        token_char, token_char_len = char2idx(
+                [list(token) for token in tokens], char_dictionary, w_maxlen)
+        fields['token_char'] = np.array(token_char, dtype=np.int32)
+        fields['token_char_len'] = np.array(token_char_len, dtype=np.int32)
+        fields['tokens'] = tokens
+        fields['c_raw'] = [item['c_raw'] for item in cqa_set]
+        fields['c_real'] = [item['c_real'] for item in cqa_set]
+        fields['q_raw'] = [qa['q_raw'] for qa in qas]
+        fields['answers'] = [qa['a'] for qa in qas]
+        fields['ids'] = [qa['id'] for qa in qas]
+        return cls(**fields)
+
+    def batch(self, indices, char_table=False, trim=False):
+        # Every field of a mini-batch is a gather from the arrays above
+        paragraphs = self.q_par[indices]
+        batch = {key: getattr(self, key)[paragraphs]
+                for key in self.paragraph_fields}
+        batch.update({key: getattr(self, key)[indices]
+                for key in self.question_fields})
+        if trim:
+            # Pad only up to the longest context/question of the batch
+            c_dim = max(np.max(batch['c_len']), 1)
+            q_dim = max(np.max(batch['q_len']), 1)
+            for key in ['c', 'c_tok']:
+                batch[key] = batch[key][:, :c_dim]
+            for key in ['q', 'q_tok']:
+                batch[key] = batch[key][:, :q_dim]
+        c_tok = batch['c_tok']
+        q_tok = batch['q_tok']
+        if char_table:
+            # Char rows of the unique tokens in the batch; c_char and q_char
+            # then hold row indices into batch['char_table']
+            unique, inverse = np.unique(np.concatenate(
+                [c_tok.ravel(), q_tok.ravel()]), return_inverse=True)
+            inverse = inverse.astype(np.int32)
+            batch['char_table'] = self.token_char[unique]
+            batch['c_char'] = inverse[:c_tok.size].reshape(c_tok.shape)
+            batch['q_char'] = inverse[c_tok.size:].reshape(q_tok.shape)
+        else:
+            batch['c_char'] = self.token_char[c_tok]
+            batch['c_char_len'] = self.token_char_len[c_tok]
+            batch['q_char'] = self.token_char[q_tok]
+            batch['q_char_len'] = self.token_char_len[q_tok]
+        batch['c_raw'] = [self.c_raw[p] for p in paragraphs]
+        batch['c_real'] = [self.c_real[p] for p in paragraphs]
+        batch['q_raw'] = [self.q_raw[i] for i in indices]
+        batch['answers'] = [self.answers[i] for i in indices]
+        batch['ids'] = [self.ids[i] for i in indices]
+        return batch
+
+    def batches(self, batch_size, shuffle=False, char_table=False):
+        order = np.arange(len(self))
+        if shuffle:
+            np.random.shuffle(order)
+        for start in range(0, len(order), batch_size):
+            yield self.batch(order[start:start+batch_size], char_table)
+
+    def bucket_batches(self, batch_size, char_table=False, bucket_size=20):
+        # Questions sorted by context then question length are split into
+        # buckets of bucket_size batches of similar length. Questions are
+        # shuffled within a bucket and batches across buckets, and each batch
+        # is padded only to its own maximum.
+        c_len = self.c_len[self.q_par]
+        order = np.lexsort((self.q_len, c_len))
+        bucket_len = batch_size * bucket_size
+        batch_indices = []
+        for start in range(0, len(order), bucket_len):
+            bucket = order[start:start+bucket_len]
+            np.random.shuffle(bucket)
+            batch_indices += [bucket[b_start:b_start+batch_size]
+                    for b_start in range(0, len(bucket), batch_size)]
+        np.random.shuffle(batch_indices)
+        for indices in batch_indices:
+            yield self.batch(indices, char_table, trim=True)
+
+
+def preprocess_articles(dataset, dictionary, c_maxlen, q_maxlen):
     cqa_set = []
     cnt = 0
 
     for d_idx, document in enumerate(dataset):
         for p_idx, paragraph in enumerate(document['paragraphs']):
             context = paragraph['context']
+            tokenize_paragraph(paragraph)
             cqa_item = {}
-            cqa_item['c_raw'] = tokenize(context)
+            cqa_item['c_raw'] = paragraph['c_tokens']
             cqa_item['c_real'] = context
-
-            cqa_item['c_char'] = [list(word) for word in cqa_item['c_raw']]
 	    
-            cqa_item['c'], cqa_item['c_len'] = word2idx(context, dictionary, c_maxlen)
-            cqa_item['c_char_idx'], cqa_item['char_len'] = char2idx(
-                    cqa_item['c_char'], char_dictionary, w_maxlen, c_maxlen)
-            if len(cqa_item['c_raw']) > c_maxlen: continue
+            cqa_item['c'], cqa_item['c_len'] = word2idx(
+                    cqa_item['c_raw'], dictionary, c_maxlen)
+            if not 0 < len(cqa_item['c_raw']) <= c_maxlen: continue
             if d_idx == 0 and p_idx == 0:
                 # print(context)
                 pass
@@ -271,19 +547,19 @@ def preprocess(dataset, dictionary, c_maxlen, q_maxlen, w_maxlen, char_dictionar
             for qa in paragraph['qas']:
                 cnt += 1
                 qa_item = {}
-                question = qa['question']
                 answers = qa['answers']
-                qa_item['q_raw'] = tokenize(question)
-                qa_item['q_char'] = [list(word) for word in qa_item['q_raw']]
-                qa_item['q_char_idx'], qa_item['q_char_len'] = char2idx(
-                        qa_item['q_char'], char_dictionary, w_maxlen, q_maxlen)
+                qa_item['q_raw'] = qa['q_tokens']
                 qa_item['q'], qa_item['q_len'] = word2idx(
-                        question, dictionary, q_maxlen)
-                qa_item['a_start'] = len(
-                        tokenize(context[:answers[0]['answer_start']]))
-                qa_item['a_end'] = qa_item['a_start'] + len(
-                        tokenize(answers[0]['text'])) - 1
+                        qa_item['q_raw'], dictionary, q_maxlen)
+                if not 0 < qa_item['q_len'] <= q_maxlen: continue
+                if answers:
+                    qa_item['a_start'], qa_item['a_end'] = answer_span(
+                            paragraph, answers[0]['answer_start'],
+                            answers[0]['text'])
+                else: # test sets come without answers
+                    qa_item['a_start'] = qa_item['a_end'] = 0
                 qa_item['a'] = [a['text'] for a in answers]
+                qa_item['id'] = qa['id']
                 qa_set.append(qa_item)
                 if d_idx == 0 and p_idx == 0:
                     # print(question)
@@ -292,13 +568,160 @@ def preprocess(dataset, dictionary, c_maxlen, q_maxlen, w_maxlen, char_dictionar
             cqa_item['qa'] = qa_set
             cqa_set.append(cqa_item)
 
+    return cqa_set, cnt
+
+
+def preprocess(dataset, dictionary, c_maxlen, q_maxlen, w_maxlen, 
+        char_dictionary, num_workers=1):
+    cqa_set = []
+    cnt = 0
+    for s_cqa_set, s_cnt in map_articles(preprocess_articles, dataset, 
+            num_workers, dictionary, c_maxlen, q_maxlen):
+        cqa_set += s_cqa_set
+        cnt += s_cnt
+
     # print('\nis preprocessed as \n')
     # print(cqa_set[0])
     print('Passage: %d, Question: %d' % (len(cqa_set), cnt))
 
-    return cqa_set
+    return SquadDataset.from_items(cqa_set, char_dictionary, w_maxlen)
 
 
 def load_lm(lm_path):
     pass
 
+
+def file_hash(path, chunk_size=1 << 20):
+    sha = hashlib.sha1()
+    with open(path, 'rb') as f:
+        for chunk in iter(lambda: f.read(chunk_size), b''):
+            sha.update(chunk)
+    return sha.hexdigest()
+
+
+def cache_key(params):
+    # Glove files are too large to hash, so size and mtime stand in for them
+    glove_path = os.path.expanduser(params['glove_path'])
+    glove_stat = os.stat(glove_path)
+    key = [CACHE_VERSION, TOKENIZER,
+            file_hash(params['train_path']), file_hash(params['dev_path']),
+            params['context_maxlen'], params['dim_embed_word'],
+            os.path.abspath(glove_path), glove_stat.st_size,
+            int(glove_stat.st_mtime)]
+    return hashlib.sha1(json.dumps(key).encode('utf-8')).hexdigest()
+
+
+def pack_strings(strings):
+    offsets = np.zeros(len(strings) + 1, dtype=np.int64)
+    offsets[1:] = np.cumsum([len(s) for s in strings])
+    blob = np.frombuffer(''.join(strings).encode('utf-8'), dtype=np.uint8)
+    return blob, offsets
+
+
+def unpack_strings(blob, offsets):
+    text = blob.tobytes().decode('utf-8')
+    offsets = offsets.tolist()
+    return [text[s:e] for s, e in zip(offsets[:-1], offsets[1:])]
+
+
+def ragged_offsets(lists):
+    offsets = np.zeros(len(lists) + 1, dtype=np.int64)
+    offsets[1:] = np.cumsum([len(l) for l in lists])
+    return offsets
+
+
+def save_cache(cache_path, datasets, pretrained_glove, idx2word, idx2char, 
+        c_maxlen, q_maxlen, w_maxlen):
+    print('Saving dataset cache', cache_path)
+    start_time = datetime.datetime.now()
+    arrays = {'glove': pretrained_glove}
+    arrays['idx2word'], arrays['idx2word_off'] = pack_strings(
+            [idx2word[i] for i in range(len(idx2word))])
+    arrays['idx2char'], arrays['idx2char_off'] = pack_strings(
+            [idx2char[i] for i in range(len(idx2char))])
+
+    for name, dataset in datasets.items():
+        for key in (SquadDataset.paragraph_fields + SquadDataset.question_fields
+                + SquadDataset.table_fields):
+            arrays[name + '_' + key] = getattr(dataset, key)
+        for key in ['tokens', 'c_real', 'ids']:
+            arrays[name + '_' + key], arrays[name + '_' + key + '_off'] = \
+                    pack_strings(getattr(dataset, key))
+        arrays[name + '_a'], arrays[name + '_a_off'] = pack_strings(
+                [a for answers in dataset.answers for a in answers])
+        arrays[name + '_a_cnt_off'] = ragged_offsets(dataset.answers)
+
+    # Write into a temporary directory first so a crash never leaves
+    # a half-written cache behind
+    tmp_path = cache_path.rstrip('/') + '.tmp'
+    if os.path.exists(tmp_path):
+        shutil.rmtree(tmp_path)
+    os.makedirs(tmp_path)
+    for key, value in arrays.items():
+        np.save(os.path.join(tmp_path, key + '.npy'), value, allow_pickle=False)
+    with open(os.path.join(tmp_path, 'meta.json'), 'w') as f:
+        json.dump({'version': CACHE_VERSION, 'tokenizer': TOKENIZER,
+            'splits': list(datasets.keys()), 'c_maxlen': c_maxlen,
+            'q_maxlen': q_maxlen, 'w_maxlen': w_maxlen}, f)
+    if os.path.exists(cache_path):
+        shutil.rmtree(cache_path)
+    os.rename(tmp_path, cache_path)
+
+    elapsed_time = datetime.datetime.now() - start_time
+    print('Saving dataset cache Done', elapsed_time)
+
+
+def load_cache(cache_path):
+    meta_path = os.path.join(cache_path, 'meta.json')
+    if not os.path.exists(meta_path):
+        return None
+    with open(meta_path) as f:
+        meta = json.load(f)
+    if meta['version'] != CACHE_VERSION or meta['tokenizer'] != TOKENIZER:
+        print('Stale dataset cache', cache_path)
+        return None
+
+    print('Loading dataset cache', cache_path)
+    start_time = datetime.datetime.now()
+
+    def load(key):
+        return np.load(os.path.join(cache_path, key + '.npy'), allow_pickle=False)
+
+    def load_strings(key):
+        return unpack_strings(load(key), load(key + '_off'))
+
+    def split_ragged(flat, offsets):
+        offsets = offsets.tolist()
+        return [flat[s:e] for s, e in zip(offsets[:-1], offsets[1:])]
+
+    idx2word = dict(enumerate(load_strings('idx2word')))
+    idx2char = dict(enumerate(load_strings('idx2char')))
+    word2idx = {w: i for i, w in idx2word.items()}
+    char2idx = {c: i for i, c in idx2char.items()}
+    pretrained_glove = load('glove')
+
+    datasets = {}
+    for name in meta['splits']:
+        fields = {}
+        for key in (SquadDataset.paragraph_fields + SquadDataset.question_fields
+                + SquadDataset.table_fields):
+            fields[key] = load(name + '_' + key)
+        for key in ['tokens', 'c_real', 'ids']:
+            fields[key] = load_strings(name + '_' + key)
+        fields['answers'] = split_ragged(
+                load_strings(name + '_a'), load(name + '_a_cnt_off'))
+
+        # Raw tokens are rebuilt from the token table
+        tokens = fields['tokens']
+        fields['c_raw'] = [[tokens[t] for t in c_tok[:c_len]]
+                for c_tok, c_len in zip(fields['c_tok'].tolist(),
+                    fields['c_len'].tolist())]
+        fields['q_raw'] = [[tokens[t] for t in q_tok[:q_len]]
+                for q_tok, q_len in zip(fields['q_tok'].tolist(),
+                    fields['q_len'].tolist())]
+        datasets[name] = SquadDataset(**fields)
+
+    elapsed_time = datetime.datetime.now() - start_time
+    print('Loading dataset cache Done', elapsed_time)
+    return (datasets, pretrained_glove, word2idx, idx2word, char2idx, idx2char,
+            meta['c_maxlen'], meta['q_maxlen'], meta['w_maxlen'])
@@ -0,0 +1,69 @@
+import json
+import argparse
+import tensorflow as tf
+
+from dataset import read_data
+from run import run_predict
+from server import serve
+
+
+class FrozenModel(object):
+    """Inference graph written by Basic.export.
+
+    The input and output tensors of the signature become attributes
+    (context, start_logits, ...) so build_feed_dict, run_predict and serve
+    use it like the model it was exported from.
+    """
+    def __init__(self, export_path):
+        with open(export_path + '.json') as f:
+            signature = json.load(f)
+        self.params = signature['params']
+        self.model_name = self.params['model_name']
+        self.dictionary = signature['dictionary']
+        self.char_dictionary = signature['char_dictionary']
+
+        graph_def = tf.GraphDef()
+        with open(export_path + '.pb', 'rb') as f:
+            graph_def.ParseFromString(f.read())
+        self.graph = tf.Graph()
+        with self.graph.as_default():
+            tf.import_graph_def(graph_def, name='')
+        config = tf.ConfigProto(allow_soft_placement = True)
+        config.gpu_options.allow_growth = True
+        self.session = tf.Session(graph=self.graph, config=config)
+
+        for name, tensor_name in (list(signature['inputs'].items())
+                + list(signature['outputs'].items())):
+            setattr(self, name, self.graph.get_tensor_by_name(tensor_name))
+        print("Frozen model loaded", self.model_name)
+
+
+def main():
+    parser = argparse.ArgumentParser(
+            description='Serve or predict with a model exported by --export')
+    parser.add_argument('export_path',
+            help='Exported model path without extension')
+    parser.add_argument('--predict_path', default='',
+            help='Write predictions for this SQuAD file instead of serving')
+    parser.add_argument('--pred_path', default='./results/dev-v1.1-pred.json')
+    parser.add_argument('--pred_batch_size', type=int, default=128)
+    parser.add_argument('--pred_chunk', type=int, default=50)
+    parser.add_argument('--prefetch', type=int, default=4)
+    parser.add_argument('--preprocess_workers', type=int, default=1)
+    parser.add_argument('--serve_host', default='127.0.0.1')
+    parser.add_argument('--serve_port', type=int, default=8000)
+    parser.add_argument('--serve_batch', type=int, default=32)
+    parser.add_argument('--serve_wait_ms', type=float, default=5.0)
+    args = parser.parse_args()
+
+    model = FrozenModel(args.export_path)
+    params = dict(model.params, **vars(args))
+    if args.predict_path:
+        run_predict(model, read_data(args.predict_path, '1.1'),
+                model.dictionary, model.char_dictionary, params)
+    else:
+        serve(model, model.dictionary, model.char_dictionary, params)
+
+
+if __name__ == '__main__':
+    main()
@@ -11,11 +11,13 @@ import os
 from model import Basic
 from mpcm import MPCM
 from ql_mpcm import QL_MPCM
-# from bidaf import BiDAF
-# from my_bidaf import My_BiDAF
+from bidaf import BiDAF
+from my_bidaf import My_BiDAF
 from time import gmtime, strftime
 from dataset import read_data, build_dict, load_glove, preprocess, load_lm
-from run import run_epoch
+from dataset import cache_key, load_cache, save_cache
+from run import run_epoch, run_predict
+from server import serve
 
 flags = tf.app.flags
 # Basic model settings
@@ -24,6 +26,7 @@ flags.DEFINE_integer("dim_embed_word", 300, "Dimension of word embedding (300)")
 flags.DEFINE_integer("dim_rnn_cell", 100, "Dimension of RNN cell (100)")
 flags.DEFINE_integer("dim_hidden", 100, "Dimension of hidden layer")
 flags.DEFINE_integer("rnn_layer", 1, "Layer number of RNN ")
+flags.DEFINE_string("rnn_engine", "cell", "[cell] LSTM cells [fused] LSTMBlockFusedCell")
 flags.DEFINE_integer("context_maxlen", 0, "Predefined context length (0 for max)")
 flags.DEFINE_float("rnn_dropout", 0.5, "Dropout of RNN cell")
 flags.DEFINE_float("hidden_dropout", 0.5, "Dropout rate of hidden layer")
@@ -36,14 +39,29 @@ flags.DEFINE_string("optimizer", "a", "[s]sgd [m]momentum [a]adam")
 flags.DEFINE_integer('train_epoch', 100, 'Training epoch')
 flags.DEFINE_integer('test_epoch', 1, 'Test for every n training epoch')
 flags.DEFINE_integer("validation_cnt", 100, "Number of model validation")
+flags.DEFINE_integer("max_answer_len", 15, "Maximum answer span tokens (0 for any)")
 flags.DEFINE_boolean("debug", False, "True to show debug message")
 flags.DEFINE_boolean("save", False, "True to save model after testing")
 flags.DEFINE_boolean("sample_params", False, "True to sample parameters")
 flags.DEFINE_boolean("early_stop", False, "True to make early stop")
 flags.DEFINE_boolean("load", False, "True to load model")
 flags.DEFINE_boolean("train", True, "True to train model")
+flags.DEFINE_boolean("predict", False, "True to only write predictions (needs load)")
+flags.DEFINE_integer("pred_batch_size", 128, "Size of prediction batch (128)")
+flags.DEFINE_integer("pred_chunk", 50, "Articles preprocessed per prediction chunk")
+flags.DEFINE_boolean("serve", False, "True to serve predictions over HTTP (needs load)")
+flags.DEFINE_string("serve_host", "127.0.0.1", "Inference server host")
+flags.DEFINE_integer("serve_port", 8000, "Inference server port")
+flags.DEFINE_integer("serve_batch", 32, "Maximum requests per micro-batch")
+flags.DEFINE_float("serve_wait_ms", 5.0, "Maximum wait to fill a micro-batch (ms)")
+flags.DEFINE_boolean("export", False, "True to export a frozen inference graph (needs load)")
 flags.DEFINE_boolean("summarize", False, "True to have summarization")
+flags.DEFINE_integer("summary_every", 5, "Batches between summaries")
 flags.DEFINE_boolean("embed_trainable", False, "True to optimize embedded words")
+flags.DEFINE_boolean("bucket_batch", False, "True to batch by length (m, q only)")
+flags.DEFINE_integer("prefetch", 4, "Batches prepared ahead in background (0 off)")
+flags.DEFINE_boolean("use_cache", True, "True to cache preprocessed dataset")
+flags.DEFINE_integer("preprocess_workers", 1, "Processes for preprocessing")
 flags.DEFINE_string("load_name", "m100_6Bchar", "load model name")
 flags.DEFINE_string("model_name", "none", "Replaced by load_name or auto-named")
 flags.DEFINE_string("mode", "q", "b: basic, m: mpcm, q: ql_mpcm")
@@ -51,6 +69,8 @@ flags.DEFINE_string("ymdhms", "none", "Model index (ymdhMs)")
 
 # MPCM settings
 flags.DEFINE_integer("dim_perspective", 20, "Maximum number of perspective (20)")
+flags.DEFINE_integer("matching_chunk", 0, "Context positions per matching step (0 all)")
+flags.DEFINE_string("matching_impl", "matmul", "[matmul] batched matmul [scan] tf.scan")
 
 # Paraphrase settings
 flags.DEFINE_integer("num_paraphrase", 1, "Maximum iter of question paraphrasing")
@@ -68,6 +88,12 @@ flags.DEFINE_float("init_exp", 0.0, "Initial exploration prob")
 flags.DEFINE_float("final_exp", 0.0, "Final exploration prob")
 flags.DEFINE_boolean("anneal_exp", False, "True to anneal exploration")
 flags.DEFINE_boolean("train_pp_only", True, "True to train paraphrase only")
+flags.DEFINE_boolean("paraphrase_in_graph", False, "True to apply paraphrase rules in graph")
+flags.DEFINE_boolean("cache_baseline", True, "True to reuse baselines of a frozen reader")
+flags.DEFINE_integer("replay_capacity", 0, "Paraphrase replay buffer batches (0 off)")
+flags.DEFINE_float("replay_ratio", 1.0, "Replayed updates per paraphrase rollout")
+flags.DEFINE_float("replay_clip", 2.0, "Truncation of replay importance weights")
+flags.DEFINE_string("replay_eviction", "fifo", "[fifo] oldest [random] [priority] low advantage")
 
 # Bidaf settings
 flags.DEFINE_integer("highway_num_layers", 2, "highway_num_layers [2]")
@@ -81,6 +107,8 @@ flags.DEFINE_boolean("highway", True, "Use highway? [True]")
 flags.DEFINE_boolean('load_seo', True, "load Seo's pretrained bidaf")
 flags.DEFINE_string('logit_func', 'tri_linear', 'logit func [tri_linear]')
 flags.DEFINE_string('answer_func', 'linear', 'answer logit func [linear]')
+flags.DEFINE_string('attention_impl', 'matmul', '[matmul] trilinear by projections [tile] tiled')
+flags.DEFINE_integer('context_cache', 0, 'Cached context encodings at inference (0 for none)')
 
 # Path settings
 flags.DEFINE_string('checkpoint_dir', './results/ckpt/', 'Checkpoint directory')
@@ -88,20 +116,24 @@ flags.DEFINE_string('summary_dir', './results/summary/', 'summary writer')
 flags.DEFINE_string('train_path', './data/train-v1.1.json', 'Training dataset path')
 flags.DEFINE_string('dev_path', './data/dev-v1.1.json',  'Development dataset path')
 flags.DEFINE_string('pred_path', './results/dev-v1.1-pred.json', 'Pred output path')
+flags.DEFINE_string('export_dir', './results/export/', 'Frozen inference graph directory')
+flags.DEFINE_string('predict_path', '', 'Dataset to predict (dev_path if empty)')
 flags.DEFINE_string('lm_path', './data/langmodel.pkl', 'Pretrained LM path')
 flags.DEFINE_string("glove_size", "6", "use 6B or 840B for glove")
 flags.DEFINE_string('glove_path', \
         ('~/common/glove/glove.'+ tf.app.flags.FLAGS.glove_size + 'B.'
             + str(tf.app.flags.FLAGS.dim_embed_word) +'d.txt'), 'embed path')
 flags.DEFINE_string('validation_path', './results/validation.txt', 'Validation path')
+flags.DEFINE_string('cache_dir', './data/cache/', 'Preprocessed dataset cache')
 
 # Character embedding
 flags.DEFINE_string('char_emb_dim', 8,'Character embedding dimension')
 flags.DEFINE_string('filter_width', 5, 'CNN fiter width')
 flags.DEFINE_string('cnn_layer',1, 'Number of CNN layer')
 flags.DEFINE_string('char_out',100,'Character output dim (num of filter)') # TODO
-flags.DEFINE_string('share_conv',True,'Share cnn for context and question')
+flags.DEFINE_boolean('share_conv',True,'Share cnn for context and question')
 flags.DEFINE_string('cnn_keep_prob',0.8,'Dropout for CNN layer')
+flags.DEFINE_boolean('char_table', False, 'Run char CNN once per unique word')
 
 FLAGS = flags.FLAGS
 
@@ -193,35 +225,54 @@ def main(_):
     if not os.path.exists(saved_params['summary_dir']):
         os.makedirs(saved_params['summary_dir'])
 
-    # Load dataset once
+    # Load dataset once (from the preprocessed cache when it is valid)
     train_path = saved_params['train_path']
     dev_path = saved_params['dev_path']
-    train_dataset = read_data(train_path, expected_version)
-    dev_dataset = read_data(dev_path, expected_version)
+    cache_path = cached = None
+    if saved_params['use_cache']:
+        cache_path = os.path.join(
+                saved_params['cache_dir'], cache_key(saved_params))
+        cached = load_cache(cache_path)
+
+    if cached is not None:
+        (datasets, pretrained_glove, word2idx, idx2word, char2idx, idx2char,
+                c_maxlen, q_maxlen, word_maxlen) = cached
+        train_dataset = datasets['train']
+        dev_dataset = datasets['dev']
+    else:
+        train_dataset = read_data(train_path, expected_version)
+        dev_dataset = read_data(dev_path, expected_version)
     
-    """
-    Dataset is structured in json format:
-        articles (list)
-        - paragraphs (list)
-            - context
-            - qas (list)
-                - answers
-                - question
-                - id 
-        - title
-    """
-    # Preprocess dataset
-    whole_dataset = np.append(train_dataset, dev_dataset, axis=0)
-    word2idx, idx2word, c_maxlen, q_maxlen, word_maxlen, char2idx, idx2char = \
-            build_dict(whole_dataset, saved_params)
-    pretrained_glove, word2idx, idx2word = load_glove(word2idx, saved_params)
-    if saved_params['context_maxlen'] > 0: 
-        c_maxlen = saved_params['context_maxlen']
-
-    train_dataset = preprocess(
-            train_dataset, word2idx, c_maxlen, q_maxlen,word_maxlen, char2idx)
-    dev_dataset = preprocess(
-            dev_dataset, word2idx, c_maxlen, q_maxlen, word_maxlen, char2idx)
+        """
+        Dataset is structured in json format:
+            articles (list)
+            - paragraphs (list)
+                - context
+                - qas (list)
+                    - answers
+                    - question
+                    - id 
+            - title
+        """
+        # Preprocess dataset
+        whole_dataset = np.append(train_dataset, dev_dataset, axis=0)
+        word2idx, idx2word, c_maxlen, q_maxlen, word_maxlen, char2idx, idx2char = \
+                build_dict(whole_dataset, saved_params)
+        pretrained_glove, word2idx, idx2word = load_glove(word2idx, saved_params)
+        if saved_params['context_maxlen'] > 0: 
+            c_maxlen = saved_params['context_maxlen']
+
+        train_dataset = preprocess(
+                train_dataset, word2idx, c_maxlen, q_maxlen,word_maxlen, char2idx,
+                saved_params['preprocess_workers'])
+        dev_dataset = preprocess(
+                dev_dataset, word2idx, c_maxlen, q_maxlen, word_maxlen, char2idx,
+                saved_params['preprocess_workers'])
+        if cache_path is not None:
+            save_cache(cache_path, {'train': train_dataset, 'dev': dev_dataset},
+                    pretrained_glove, idx2word, idx2char,
+                    c_maxlen, q_maxlen, word_maxlen)
+
     saved_params['context_maxlen'] = c_maxlen
     saved_params['question_maxlen'] = q_maxlen
     saved_params['voca_size'] = len(word2idx)
@@ -239,7 +290,8 @@ def main(_):
         # Model name settings
         ymdhms = datetime.datetime.now().strftime('%Y%m%d%H%M%S') 
         params['ymdhms'] = ymdhms
-        if params['load']:
+        if (params['load'] or params['predict'] or params['serve'] 
+                or params['export']):
             params['model_name'] = params['load_name']
         else:
             params['model_name'] = '%s%d_%s_%d' % (params['mode'],
@@ -248,6 +300,8 @@ def main(_):
         print('\nModel_%d paramter set' % (model_idx))
         pprint.PrettyPrinter().pprint(params)
 
+        assert not params['bucket_batch'] or params['mode'] in ['m', 'q'], \
+                "Bucketed batches need dynamic RNNs (m, q): %s" % params['mode']
         if 'm' == params['mode']:
             my_model = MPCM(params, initializer=[pretrained_glove, word2idx])
         elif 'q' == params['mode']:
@@ -261,8 +315,23 @@ def main(_):
         else:
             assert False, "Check your version %s" % params['mode']
 
-        if params['load']:
+        if (params['load'] or params['predict'] or params['serve'] 
+                or params['export']):
             my_model.load(params['checkpoint_dir'])
+
+        if params['export']:
+            my_model.export(params['export_dir'], word2idx, char2idx)
+            break
+
+        if params['predict']:
+            predict_path = params['predict_path'] or dev_path
+            run_predict(my_model, read_data(predict_path, expected_version),
+                    word2idx, char2idx, params)
+            break
+
+        if params['serve']:
+            serve(my_model, word2idx, char2idx, params)
+            break
        
         em, f1, max_ep = run(my_model, params, train_dataset, dev_dataset, idx2word)
         write_result(params, em, f1, max_ep)
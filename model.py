@@ -1,8 +1,10 @@
 import tensorflow as tf
 import os
+import json
 import datetime
 
 from ops import *
+from utils import BackgroundSummaryWriter
 
 
 class Basic(object):
@@ -30,6 +32,7 @@ class Basic(object):
         self.dim_hidden = params['dim_hidden']
         self.dim_rnn_cell = params['dim_rnn_cell']
         self.dim_output = params['dim_output']
+        self.rnn_engine = params['rnn_engine']
         self.embed_trainable = params['embed_trainable']
         self.checkpoint_dir = params['checkpoint_dir']
         self.summary_dir = params['summary_dir']
@@ -42,10 +45,18 @@ class Basic(object):
         self.char_out = params['char_out']
         self.char_size = params['char_size']
         self.share_conv = params['share_conv']
+        self.use_char_table = params['char_table']
+
+        # With bucketed batches the time dimensions follow the longest
+        # context/question of each batch instead of the global maximum
+        if params['bucket_batch']:
+            c_time = q_time = None
+        else:
+            c_time, q_time = self.context_maxlen, self.question_maxlen
 
         # input data placeholders
-        self.context = tf.placeholder(tf.int32, [None, self.context_maxlen])
-        self.question = tf.placeholder(tf.int32, [None, self.question_maxlen])
+        self.context = tf.placeholder(tf.int32, [None, c_time])
+        self.question = tf.placeholder(tf.int32, [None, q_time])
         self.answer_start = tf.placeholder(tf.int32, [None])
         self.answer_end = tf.placeholder(tf.int32, [None])
         self.context_len = tf.placeholder(tf.int32, [None])
@@ -54,17 +65,27 @@ class Basic(object):
         self.hidden_dropout = tf.placeholder(tf.float32)
         self.embed_dropout = tf.placeholder(tf.float32)
         self.learning_rate = tf.placeholder(tf.float32)
-        self.context_char = tf.placeholder(tf.int32, 
-                [None, self.context_maxlen, self.word_maxlen])
-        self.question_char = tf.placeholder(tf.int32, 
-                [None, self.question_maxlen, self.word_maxlen])
+        if self.use_char_table:
+            # Char ids of the unique words in a batch; context_char and
+            # question_char then hold row indices into char_table
+            self.char_table = tf.placeholder(tf.int32, [None, self.word_maxlen])
+            self.context_char = tf.placeholder(tf.int32, [None, c_time])
+            self.question_char = tf.placeholder(tf.int32, [None, q_time])
+        else:
+            self.char_table = None
+            self.context_char = tf.placeholder(tf.int32, 
+                    [None, c_time, self.word_maxlen])
+            self.question_char = tf.placeholder(tf.int32, 
+                    [None, q_time, self.word_maxlen])
         self.cnn_keep_prob = tf.placeholder(tf.float32)
 
         # model settings
+        self.context_dim = c_time or tf.shape(self.context)[1]
+        self.question_dim = q_time or tf.shape(self.question)[1]
         self.context_mask = tf.sequence_mask(self.context_len, 
-                self.context_maxlen, dtype=tf.float32)
+                self.context_dim, dtype=tf.float32)
         self.question_mask = tf.sequence_mask(self.question_len, 
-                self.question_maxlen, dtype=tf.float32)
+                self.question_dim, dtype=tf.float32)
         self.global_step = tf.Variable(0, name="step", trainable=False)
         if params['optimizer'] == 's': 
             self.optimizer = tf.train.GradientDescentOptimizer(self.learning_rate)
@@ -75,13 +96,17 @@ class Basic(object):
         else:
             assert False, 'Wrong optimizer %s' % params['optimizer']
         self.no_op = tf.no_op()
-        self.initialize_embedding(self.initializer)
+        self.embed_feed = dict([self.initialize_embedding(self.initializer)])
 
         # build model
         start_time = datetime.datetime.now()
         self.build_model()
         self.save_settings()
-        self.session.run(tf.global_variables_initializer())
+        self.session.run(tf.global_variables_initializer(), 
+                feed_dict=self.embed_feed)
+
+        # The GloVe matrix now lives in Word/embed only
+        self.embed_feed = self.initializer = None
         elapsed_time = datetime.datetime.now() - start_time
         print('Model Building Done', elapsed_time)
        
@@ -104,6 +129,9 @@ class Basic(object):
                 reuse=reuse, scope='Word'), self.embed_dropout)
 
         with tf.variable_scope(scope) as scope: 
+            if self.rnn_engine == 'fused':
+                return fused_rnn_model(inputs_embed, length, 
+                        self.dim_rnn_cell, self.rnn_layer, self.rnn_dropout)
             fw_cell = lstm_cell(self.dim_rnn_cell, self.rnn_layer, self.rnn_dropout)
             bw_cell = lstm_cell(self.dim_rnn_cell, self.rnn_layer, self.rnn_dropout) 
             inputs_reshape = rnn_reshape(inputs_embed, dim_embed, max_length)
@@ -111,6 +139,14 @@ class Basic(object):
                     inputs_reshape, length, max_length, fw_cell, self.params)
             return outputs
 
+    def bi_rnn_layer(self, inputs, length, dim_rnn_cell, rnn_layer):
+        if self.rnn_engine == 'fused':
+            return fused_bi_rnn_model(inputs, length, 
+                    dim_rnn_cell, rnn_layer, self.rnn_dropout)
+        fw_cell = lstm_cell(dim_rnn_cell, rnn_layer, self.rnn_dropout)
+        bw_cell = lstm_cell(dim_rnn_cell, rnn_layer, self.rnn_dropout)
+        return bi_rnn_model(inputs, length, fw_cell, bw_cell)
+
     def build_model(self):
         print("###  Building a Basic model ###")
         context_encoded = self.encoder(inputs=self.context,
@@ -136,44 +172,56 @@ class Basic(object):
                 output_dim=self.dim_hidden,
                 dropout_rate=self.hidden_dropout,
                 activation=tf.nn.relu,
-                scope='Hidden1')
+                scope='Hidden1',
+                summarize=self.params['summarize'])
         print('hidden', hidden1)
 
         start_logits = linear(inputs=hidden1,
             output_dim=self.dim_output,
-            scope='Output_s')
+            scope='Output_s',
+            summarize=self.params['summarize'])
 
         end_logits = linear(inputs=hidden1,
             output_dim=self.dim_output, 
-            scope='Output_e')
+            scope='Output_e',
+            summarize=self.params['summarize'])
 
         print('start, end logits', start_logits, end_logits)
         self.optimize_loss(start_logits, end_logits)
     
     def optimize_loss(self, start_logits, end_logits, vars=None):
-        start_loss = tf.reduce_mean(tf.nn.sparse_softmax_cross_entropy_with_logits(
-            logits=start_logits, labels=self.answer_start)) 
-        end_loss = tf.reduce_mean(tf.nn.sparse_softmax_cross_entropy_with_logits(
-            logits=end_logits, labels=self.answer_end))
-        self.loss = start_loss + end_loss
-        tf.summary.scalar('Loss', self.loss)
+        start_losses = tf.nn.sparse_softmax_cross_entropy_with_logits(
+            logits=start_logits, labels=self.answer_start)
+        end_losses = tf.nn.sparse_softmax_cross_entropy_with_logits(
+            logits=end_logits, labels=self.answer_end)
+        self.example_loss = start_losses + end_losses
+        self.loss = tf.reduce_mean(start_losses) + tf.reduce_mean(end_losses)
+        if self.params['summarize']:
+            tf.summary.scalar('Loss', self.loss)
         
         print('# Calculating derivatives.. \n')
         if vars == None:
             self.variables = tf.trainable_variables()
         else:
             self.variables = vars
+        # Changes whenever the optimized weights do
+        self.variables_fingerprint = tf.stack(
+                [tf.reduce_sum(v) for v in self.variables])
         self.grads, _ = tf.clip_by_global_norm(tf.gradients(self.loss, self.variables),
                 self.max_grad_norm)
         self.optimize = self.optimizer.apply_gradients(
                 zip(self.grads, self.variables), global_step=self.global_step)
     
     def initialize_embedding(self, word_embed):
+        # The initial value is fed with the variables initializer so the
+        # matrix stays out of the GraphDef
         with tf.variable_scope("Word"):
+            word_embed_ph = tf.placeholder(tf.float32, word_embed.shape)
             word_embeddings = tf.get_variable("embed",
-                    initializer=tf.constant(word_embed),
+                    initializer=word_embed_ph,
                     trainable=self.embed_trainable,
                     dtype=tf.float32)
+        return word_embed_ph, word_embed
 
     def apply_mask(self, target, mask):
         if len(target.get_shape()) > len(mask.get_shape()):
@@ -200,16 +248,16 @@ class Basic(object):
                     ('Similarity_Layer' not in v.name)]
         else:
             model_vars = [v for v in tf.trainable_variables()]
-        self.loader = tf.train.Saver(model_vars)
+        self.loader_vars = model_vars
         model_vars = [v for v in tf.trainable_variables()]
         self.saver = tf.train.Saver(model_vars)
         self.merged_summary = tf.summary.merge_all()
         # could add self.session.graph
         if self.params['summarize']:
-            self.train_writer = tf.summary.FileWriter(
-                    self.summary_dir + self.ymdhms + '/train') 
-            self.valid_writer = tf.summary.FileWriter(
-                    self.summary_dir + self.ymdhms + '/valid') 
+            self.train_writer = BackgroundSummaryWriter(tf.summary.FileWriter(
+                    self.summary_dir + self.ymdhms + '/train'))
+            self.valid_writer = BackgroundSummaryWriter(tf.summary.FileWriter(
+                    self.summary_dir + self.ymdhms + '/valid'))
 
     @staticmethod
     def reset_graph():
@@ -220,8 +268,51 @@ class Basic(object):
         self.saver.save(self.session, os.path.join(checkpoint_dir, file_name))
         print("Model saved", file_name)
 
+    def inference_inputs(self):
+        # Placeholders that build_feed_dict feeds at test time
+        inputs = ['context', 'context_len', 'question', 'question_len',
+                'answer_start', 'answer_end', 'rnn_dropout', 'hidden_dropout',
+                'embed_dropout', 'learning_rate', 'context_char',
+                'question_char', 'cnn_keep_prob']
+        if self.params['char_table']:
+            inputs.append('char_table')
+        return inputs
+
+    def export(self, export_dir, dictionary, char_dictionary):
+        # Freezes the weights into constants and prunes the graph to what the
+        # start/end logits need (no optimizer, summaries or unused policy).
+        # Loaded by frozen.FrozenModel without the model classes.
+        inputs = {name: getattr(self, name).name 
+                for name in self.inference_inputs()}
+        outputs = {name: getattr(self, name).name
+                for name in ['start_logits', 'end_logits']}
+        graph_def = tf.graph_util.convert_variables_to_constants(
+                self.session, self.session.graph.as_graph_def(),
+                [tensor_name.split(':')[0] for tensor_name in
+                    list(inputs.values()) + list(outputs.values())])
+        for node in graph_def.node:
+            node.device = ''
+
+        file_name = "%s" % self.model_name
+        tf.train.write_graph(graph_def, export_dir, file_name + '.pb', 
+                as_text=False)
+        signature = {'inputs': inputs, 'outputs': outputs,
+                'params': {key: self.params[key] for key in [
+                    'mode', 'model_name', 'context_maxlen', 'question_maxlen',
+                    'word_maxlen', 'char_table', 'max_answer_len', 
+                    'bucket_batch', 'rnn_dropout', 'hidden_dropout', 
+                    'embed_dropout', 'learning_rate', 'cnn_keep_prob']},
+                'dictionary': dictionary, 'char_dictionary': char_dictionary}
+        with open(os.path.join(export_dir, file_name + '.json'), 'w') as f:
+            json.dump(signature, f)
+        print("Model exported", file_name, "(%d nodes)" % len(graph_def.node))
+
     def load(self, checkpoint_dir):
         file_name = "%s" % self.model_name
-        self.loader.restore(self.session, os.path.join(checkpoint_dir, file_name))
+        checkpoint_path = os.path.join(checkpoint_dir, file_name)
+        # Map LSTM variables to the names used by the checkpoint's RNN engine
+        loader = tf.train.Saver(
+                rnn_checkpoint_map(self.loader_vars, checkpoint_path))
+        loader.restore(self.session, checkpoint_path)
         print("Model loaded", file_name)
 
@@ -8,6 +8,8 @@ from ops import *
 class MPCM(Basic):
     def __init__(self, params, initializer):
         self.dim_perspective = params['dim_perspective']
+        self.matching_impl = params['matching_impl']
+        self.matching_chunk = params['matching_chunk']
         super(MPCM, self).__init__(params, initializer)
 
     def filter_layer(self, context, question, reuse=None):
@@ -25,12 +27,13 @@ class MPCM(Basic):
 
     def representation_layer(self, inputs, length, max_length, scope=None, reuse=None):
         with tf.variable_scope('Representation_Layer/' + scope, reuse=reuse) as scope:
-            fw_cell = lstm_cell(self.dim_rnn_cell, self.rnn_layer, self.rnn_dropout)
-            bw_cell = lstm_cell(self.dim_rnn_cell, self.rnn_layer, self.rnn_dropout)
-            outputs, state = bi_rnn_model(inputs, length, fw_cell, bw_cell)
+            outputs, state = self.bi_rnn_layer(inputs, length, 
+                    self.dim_rnn_cell, self.rnn_layer)
             return outputs, state
     
-    def matching_layer(self, context, question, reuse=None):
+    def matching_layer(self, context, question, reuse=None, question_len=None):
+        if question_len is None:
+            question_len = self.question_len
         with tf.variable_scope('Matching_Layer', reuse=reuse) as scope: 
             def matching_function(w, c, q):
                 with tf.device('/gpu:0'):
@@ -79,29 +82,77 @@ class MPCM(Basic):
 
                 return fw_tr, bw_tr
 
+            def matmul_matching_function(w, c, q):
+                # Same cosine similarities as matching_function, computed as
+                # one batched matmul per direction instead of a scan over C
+                def weighted_halves(x):
+                    # [B, T, 2H] => [B, 1, T, 2H] * [1, 3L, 1, 2H] => [B, 3L, T, H] x 2
+                    x_w = tf.multiply(tf.expand_dims(x, 1), 
+                            tf.expand_dims(tf.expand_dims(w, 1), 0))
+                    halves = tf.split(x_w, num_or_size_splits=2, axis=3)
+                    return [h / tf.sqrt(tf.maximum(tf.reduce_sum(
+                        tf.square(h), axis=-1, keep_dims=True), 1e-6))
+                        for h in halves]
+
+                qf, qb = weighted_halves(q)
+
+                def match(c_part):
+                    # [B, 3L, T, H] X [B, 3L, Q, H] => [B, 3L, T, Q] => [B, T, Q, 3L]
+                    cf, cb = weighted_halves(c_part)
+                    fw = tf.matmul(cf, qf, transpose_b=True)
+                    bw = tf.matmul(cb, qb, transpose_b=True)
+                    return (tf.transpose(fw, [0, 2, 3, 1]), 
+                            tf.transpose(bw, [0, 2, 3, 1]))
+                
+                if self.matching_chunk <= 0:
+                    fw_tr, bw_tr = match(c)
+                else:
+                    # Match matching_chunk context positions at a time to bound
+                    # the size of the weighted context tensors
+                    chunk = self.matching_chunk
+                    batch_size = tf.shape(c)[0]
+                    c_len = tf.shape(c)[1]
+                    c_pad = tf.pad(c, [[0, 0], [0, (chunk - c_len % chunk) % chunk],
+                        [0, 0]])
+                    c_chunks = tf.transpose(tf.reshape(c_pad, 
+                        [batch_size, -1, chunk, self.dim_rnn_cell * 2]), [1, 0, 2, 3])
+                    fw_chunks, bw_chunks = tf.map_fn(match, c_chunks,
+                            dtype=(tf.float32, tf.float32), parallel_iterations=1)
+
+                    def merge(chunks):
+                        # [N, B, chunk, Q, 3L] => [B, C, Q, 3L]
+                        merged = tf.transpose(chunks, [1, 0, 2, 3, 4])
+                        merged = tf.reshape(merged, [batch_size, -1, 
+                            tf.shape(q)[1], self.dim_perspective * 3])
+                        return merged[:, :c_len]
+                    fw_tr, bw_tr = merge(fw_chunks), merge(bw_chunks)
+                print('\tmatching function', fw_tr)
+
+                return fw_tr, bw_tr
+
             def full_matching(fw, bw):
                 batch_size = tf.shape(fw)[0]
                 batch_index = tf.reshape(tf.tile(
                     tf.expand_dims(tf.range(0, batch_size), 1), 
-                    [1, self.context_maxlen]), [-1])
+                    [1, self.context_dim]), [-1])
                 context_index = tf.reshape(tf.tile(
-                    tf.expand_dims(tf.range(0, self.context_maxlen), 0),
+                    tf.expand_dims(tf.range(0, self.context_dim), 0),
                     [batch_size, 1]), [-1])
                 question_index = tf.reshape(tf.tile(
-                    tf.expand_dims(self.question_len - 1, 1),
-                    [1, self.context_maxlen]), [-1])
+                    tf.expand_dims(question_len - 1, 1),
+                    [1, self.context_dim]), [-1])
                 fw_indices = tf.concat([tf.expand_dims(batch_index, 1),
                     tf.expand_dims(context_index, 1),
                     tf.expand_dims(question_index, 1)], axis=1)
                 bw_indices = tf.concat([tf.expand_dims(batch_index, 1),
                     tf.expand_dims(context_index, 1),
-                    tf.expand_dims(tf.zeros([batch_size * self.context_maxlen], 
+                    tf.expand_dims(tf.zeros([batch_size * self.context_dim], 
                         dtype=tf.int32), 1)], axis=1)
 
                 gathered_fw = tf.reshape(tf.gather_nd(fw, fw_indices), 
-                        [-1, self.context_maxlen, self.dim_perspective])
+                        [-1, self.context_dim, self.dim_perspective])
                 gathered_bw = tf.reshape(tf.gather_nd(bw, bw_indices),
-                        [-1, self.context_maxlen, self.dim_perspective])
+                        [-1, self.context_dim, self.dim_perspective])
                 
                 result = tf.concat([gathered_fw, gathered_bw], axis=2)
                 print('\tfull matching', result)
@@ -126,7 +177,12 @@ class MPCM(Basic):
             w_matching = tf.get_variable('w_matching', 
                     [self.dim_perspective * 3, self.dim_rnn_cell * 2],
                     initializer=tf.random_normal_initializer(), dtype=tf.float32)
-            fw_matching, bw_matching = matching_function(w_matching, context, question)
+            if self.matching_impl == 'matmul':
+                fw_matching, bw_matching = matmul_matching_function(
+                        w_matching, context, question)
+            else:
+                fw_matching, bw_matching = matching_function(
+                        w_matching, context, question)
             
             with tf.device('/gpu:0'):
                 full_fw, max_fw, mean_fw = tf.split(
@@ -145,15 +201,16 @@ class MPCM(Basic):
 
     def aggregation_layer(self, inputs, max_length, length, reuse=None):
         with tf.variable_scope('Aggregation_Layer', reuse=reuse) as scope:
-            fw_cell = lstm_cell(self.dim_rnn_cell, self.rnn_layer, self.rnn_dropout)
-            bw_cell = lstm_cell(self.dim_rnn_cell, self.rnn_layer, self.rnn_dropout)
-            outputs, _ = bi_rnn_model(inputs, length, fw_cell, bw_cell)
+            outputs, _ = self.bi_rnn_layer(inputs, length, 
+                    self.dim_rnn_cell, self.rnn_layer)
             
             print('\tinputs', inputs)
             print('\toutputs', outputs)
             return outputs
 
-    def prediction_layer(self, inputs, reuse=None):
+    def prediction_layer(self, inputs, reuse=None, context_mask=None):
+        if context_mask is None:
+            context_mask = self.context_mask
         with tf.variable_scope('Prediction_Layer', reuse=reuse) as scope:
             """
             start_hidden = linear(inputs=inputs,
@@ -164,8 +221,9 @@ class MPCM(Basic):
             """
             start_logits = linear(inputs=inputs,
                 output_dim=1,
-                scope='Output_s')
-            start_logits = tf.reshape(start_logits, [-1, self.dim_output])
+                scope='Output_s',
+                summarize=self.params['summarize'])
+            start_logits = tf.reshape(start_logits, [-1, self.context_dim])
             
             """
             end_hidden = linear(inputs=inputs,
@@ -176,12 +234,13 @@ class MPCM(Basic):
             """
             end_logits = linear(inputs=inputs,
                 output_dim=1,
-                scope='Output_e')
-            end_logits = tf.reshape(end_logits, [-1, self.dim_output])
+                scope='Output_e',
+                summarize=self.params['summarize'])
+            end_logits = tf.reshape(end_logits, [-1, self.context_dim])
             
             # Masking start, end logits
-            start_logits = tf.multiply(start_logits, self.context_mask)
-            end_logits = tf.multiply(end_logits, self.context_mask)
+            start_logits = tf.multiply(start_logits, context_mask)
+            end_logits = tf.multiply(end_logits, context_mask)
             return start_logits, end_logits
     
     def char_conv(self, inputs, emb_dim, output_dim, 
@@ -209,25 +268,35 @@ class MPCM(Basic):
                #    dtype = tf.float32)
                # char_emb_matrix = tf.concat([char_emb_pad,char_emb_matrix],0)
 
-            char_context_emb = tf.nn.embedding_lookup(char_emb_matrix, context_char)
-            char_question_emb = tf.nn.embedding_lookup(char_emb_matrix, question_char)
+            def conv(char_emb, scope):
+                # char_conv always opens 'conv', so an unshared question
+                # conv lives under its own scope
+                with tf.variable_scope(scope):
+                    return self.char_conv(char_emb, char_emb_dim, char_out,
+                            filter_width, 'VALID', keep_prob=cnn_keep_prob)
 
-            with tf.variable_scope('conv'):
-                char_conv_context = self.char_conv(
-                        char_context_emb,char_emb_dim,char_out,
-                        filter_width,'VALID',
-                        scope = 'char_context', keep_prob = cnn_keep_prob)
+            if self.use_char_table:
+                # Run the char CNN once per unique word, then gather it back
+                char_table_emb = tf.expand_dims(tf.nn.embedding_lookup(
+                    char_emb_matrix, self.char_table), 0)
+                char_conv_table = tf.squeeze(conv(char_table_emb, 'conv'), [0])
                 if share_conv:
-                    tf.get_variable_scope().reuse_variables()
-                    char_conv_question = self.char_conv(
-                            char_question_emb,char_emb_dim, char_out,
-                            filter_width,'VALID', 
-                            scope = 'char_context', keep_prob = cnn_keep_prob) 
+                    char_conv_q_table = char_conv_table
                 else:
-                    char_conv_question = self.char_conv(
-                              char_question_emb,char_emb_dem, self.char_out,
-                            filter_width,'VALID', 
-                            scope = 'char_question', keep_prob = cnn_keep_prob)
+                    char_conv_q_table = tf.squeeze(conv(char_table_emb,
+                        'conv/char_question'), [0])
+                return (tf.gather(char_conv_table, context_char),
+                        tf.gather(char_conv_q_table, question_char))
+
+            char_context_emb = tf.nn.embedding_lookup(char_emb_matrix, context_char)
+            char_question_emb = tf.nn.embedding_lookup(char_emb_matrix, question_char)
+
+            char_conv_context = conv(char_context_emb, 'conv')
+            if share_conv:
+                with tf.variable_scope(tf.get_variable_scope(), reuse=True):
+                    char_conv_question = conv(char_question_emb, 'conv')
+            else:
+                char_conv_question = conv(char_question_emb, 'conv/char_question')
         return char_conv_context, char_conv_question
 
     def build_model(self):
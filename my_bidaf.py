@@ -41,6 +41,7 @@ def bidirectional_LSTM(hidden_size, keep_prob, X, time_step, X_len, output_dim):
 
 class My_BiDAF(Basic):
     def __init__(self, params, initializer):
+        self.attention_impl = params['attention_impl']
         super(My_BiDAF, self).__init__(params, initializer)        
 
 
@@ -74,23 +75,26 @@ class My_BiDAF(Basic):
            
             H_trans = tf.transpose(H, [0, 2, 1]) # (B, T, D)
             U_trans = tf.transpose(U, [0, 2, 1]) # (B, J, D)
-            HH = tf.expand_dims(H_trans, 2)     # (B, T, 1, D)
-            HH = tf.tile(HH, [1, 1, J, 1])      # (B, T, J, D)
-            UU = tf.expand_dims(U_trans, 1)     # (B, 1, J, D)
-            H_mul_U = tf.multiply(HH, UU)       # (B, T, J, D)
-            H_mul_U = tf.reshape(H_mul_U, [-1, T*J, D]) # (B, T*J, D)
+            w_s = tf.Variable(tf.random_normal([3*D, 1]))
 
-            HHH = tf.reshape(HH, [-1, T*J, D])
-            UUU = tf.tile(U_trans, [1, T, 1])
+            if self.attention_impl == 'matmul':
+                S = trilinear_similarity(H_trans, U_trans, w_s) # (B, T, J)
+            else:
+                HH = tf.expand_dims(H_trans, 2)     # (B, T, 1, D)
+                HH = tf.tile(HH, [1, 1, J, 1])      # (B, T, J, D)
+                UU = tf.expand_dims(U_trans, 1)     # (B, 1, J, D)
+                H_mul_U = tf.multiply(HH, UU)       # (B, T, J, D)
+                H_mul_U = tf.reshape(H_mul_U, [-1, T*J, D]) # (B, T*J, D)
 
-            concat = tf.concat([HHH, UUU, H_mul_U], 2) # (B, T*J, 3D)
+                HHH = tf.reshape(HH, [-1, T*J, D])
+                UUU = tf.tile(U_trans, [1, T, 1])
 
-            w_s = tf.Variable(tf.random_normal([3*D, 1]))
+                concat = tf.concat([HHH, UUU, H_mul_U], 2) # (B, T*J, 3D)
 
-            reshape = tf.reshape(concat, [-1, 3*D]) # (B*T*J, 3D)
-            alpha = tf.matmul(reshape, w_s)         # (B*T*J, 1)
+                reshape = tf.reshape(concat, [-1, 3*D]) # (B*T*J, 3D)
+                alpha = tf.matmul(reshape, w_s)         # (B*T*J, 1)
 
-            S = tf.reshape(alpha, [-1, T, J])       # (B, T, J)
+                S = tf.reshape(alpha, [-1, T, J])       # (B, T, J)
             
             a = tf.nn.softmax(S, -1)
             # (?, context time step, que time step)
@@ -61,11 +61,82 @@ def bi_rnn_model(inputs, input_len, fw_cell, bw_cell,
         return outputs, state
 
 
+def fused_lstm(inputs, input_len, cell_dim, layer_num, keep_prob, reverse=False):
+    # Time-major [T, B, D] stack of LSTMBlockFusedCell layers, scoped like
+    # lstm_cell so variable names line up with the MultiRNNCell ones
+    if reverse:
+        inputs = tf.reverse_sequence(inputs, input_len, seq_dim=0, batch_dim=1)
+    states = []
+    with tf.variable_scope('multi_rnn_cell'):
+        for layer_idx in range(layer_num):
+            with tf.variable_scope('cell_%d' % layer_idx):
+                cell = tf.contrib.rnn.LSTMBlockFusedCell(cell_dim, forget_bias=1.0)
+                inputs, state = cell(inputs, sequence_length=input_len,
+                        dtype=tf.float32, scope='basic_lstm_cell')
+                inputs = dropout(inputs, keep_prob)
+                states.append(state)
+    if reverse:
+        inputs = tf.reverse_sequence(inputs, input_len, seq_dim=0, batch_dim=1)
+    return inputs, tuple(states)
+
+
+def fused_rnn_model(inputs, input_len, cell_dim, layer_num, keep_prob, 
+        gather_last=False):
+    with tf.variable_scope('RNN') as scope:
+        outputs, state = fused_lstm(tf.transpose(inputs, [1, 0, 2]), 
+                input_len, cell_dim, layer_num, keep_prob)
+        outputs = tf.transpose(outputs, [1, 0, 2])
+        if gather_last:
+            indices = tf.concat(axis=1, values=[tf.expand_dims(tf.range(0, tf.shape(input_len)[0]), 1), tf.expand_dims(input_len-1, 1)])
+            gathered_outputs = tf.gather_nd(outputs, indices)
+        else:
+            gathered_outputs = outputs
+        return gathered_outputs
+
+
+def fused_bi_rnn_model(inputs, input_len, cell_dim, layer_num, keep_prob):
+    with tf.variable_scope('Bi-RNN') as scope:
+        inputs_tr = tf.transpose(inputs, [1, 0, 2])
+        with tf.variable_scope('fw'):
+            fw_outputs, fw_state = fused_lstm(inputs_tr, input_len,
+                    cell_dim, layer_num, keep_prob)
+        with tf.variable_scope('bw'):
+            bw_outputs, bw_state = fused_lstm(inputs_tr, input_len,
+                    cell_dim, layer_num, keep_prob, reverse=True)
+        outputs = tf.transpose(
+                tf.concat(axis=2, values=[fw_outputs, bw_outputs]), [1, 0, 2])
+        return outputs, (fw_state, bw_state)
+
+
+LSTM_SCOPE_ALIASES = ['basic_lstm_cell', 'lstm_block_fused_cell', 'LSTMBlockFusedCell']
+LSTM_PARAM_ALIASES = [['weights', 'kernel'], ['biases', 'bias']]
+
+
+def rnn_checkpoint_map(variables, checkpoint_path):
+    # Saver var_list naming each variable as it is stored in the checkpoint,
+    # so that cell and fused RNN engines can restore each other's LSTMs
+    stored = set(name for name, _ in 
+            tf.contrib.framework.list_variables(checkpoint_path))
+    var_map = {}
+    for var in variables:
+        name = var.op.name
+        scope, _, param = name.rpartition('/')
+        prefix, _, cell_scope = scope.rpartition('/')
+        if name not in stored and cell_scope in LSTM_SCOPE_ALIASES:
+            param_aliases = [p for p in LSTM_PARAM_ALIASES if param in p]
+            candidates = [prefix + '/' + s + '/' + p 
+                    for s in LSTM_SCOPE_ALIASES
+                    for p in (param_aliases[0] if param_aliases else [param])]
+            name = next((c for c in candidates if c in stored), name)
+        var_map[name] = var
+    return var_map
+
+
 def embedding_lookup(inputs, voca_size, embedding_dim, initializer=None, trainable=True,
         draw=False, visual_dir=None, config=None, 
         reuse=False, scope='Embedding'):
     with tf.variable_scope(scope, reuse=reuse) as scope:
-        if initializer is not None:
+        if initializer is not None and not reuse:
             embedding_table = tf.get_variable("embed",
                     initializer=initializer, trainable=trainable, dtype=tf.float32)
         else:
@@ -83,6 +154,23 @@ def embedding_lookup(inputs, voca_size, embedding_dim, initializer=None, trainab
             return inputs_embed
 
 
+def trilinear_similarity(h, u, weight, bias=None):
+    # w^T [h; u; h * u] + b of every h and u row pair, [N, ..., T, J], as two
+    # projections and a batched matmul instead of tiling to [N, ..., T, J, d]
+    with tf.variable_scope('Trilinear_Similarity') as scope:
+        dim = h.get_shape().as_list()[-1]
+        w_h, w_u, w_hu = tf.split(tf.reshape(weight, [3 * dim]), 3)
+        h_shape = tf.shape(h)
+        flat_h = tf.reshape(h, [h_shape[0], -1, dim])
+        similarity = (tf.matmul(flat_h * w_hu, u, transpose_b=True)
+                + tf.expand_dims(tf.tensordot(flat_h, w_h, 1), 2)
+                + tf.expand_dims(tf.tensordot(u, w_u, 1), 1))
+        if bias is not None:
+            similarity += bias
+        return tf.reshape(similarity, 
+                tf.concat([h_shape[:-1], tf.shape(u)[1:2]], 0))
+
+
 def mask_by_index(batch_size, input_len, max_time_step):
     with tf.variable_scope('Masking') as scope:
         input_index = tf.range(0, batch_size) * max_time_step + (input_len - 1)
@@ -98,16 +186,18 @@ def mask_by_index(batch_size, input_len, max_time_step):
         return weight
 
 
-def linear(inputs, output_dim, dropout_rate=1.0, regularize_rate=0, activation=None, scope='Linear'):
+def linear(inputs, output_dim, dropout_rate=1.0, regularize_rate=0, activation=None, scope='Linear',
+        summarize=False):
     with tf.variable_scope(scope) as scope:
         input_dim = inputs.get_shape().as_list()[-1]
         inputs = tf.reshape(inputs, [-1, input_dim])
         weights = tf.get_variable('Weights', [input_dim, output_dim],
                                   initializer=tf.random_normal_initializer())
-        variable_summaries(weights, scope.name + '/Weights')
         biases = tf.get_variable('Biases', [output_dim],
                                  initializer=tf.constant_initializer(0.0))
-        variable_summaries(biases, scope.name + '/Biases')
+        if summarize:
+            variable_summaries(weights, scope.name + '/Weights')
+            variable_summaries(biases, scope.name + '/Biases')
         if activation is None:
             return dropout((tf.matmul(inputs, weights) + biases), dropout_rate)
         else:
@@ -3,6 +3,7 @@ import sys
 
 from mpcm import MPCM
 from ops import *
+from utils import PARAPHRASE_RULES, PARAPHRASE_EDITS, BaselineCache, ReplayBuffer
 
 
 class QL_MPCM(MPCM):
@@ -20,19 +21,30 @@ class QL_MPCM(MPCM):
         self.similarity_q = params['similarity_q']
         self.similarity_c = params['similarity_c']
         self.exploration = self.init_exp
+        self.baseline_cache = BaselineCache()
+        self.paraphrase_in_graph = params['paraphrase_in_graph']
+        self.replay_clip = params['replay_clip']
+        # One policy update per pass in graph mode, one for all host rollouts
+        self.replay_buffers = [ReplayBuffer(params['replay_capacity'],
+            params['replay_eviction']) for _ in range(
+                self.num_paraphrase if self.paraphrase_in_graph else 1)]
+        self.behavior_probs = [] # probability of taken actions when sampled
         self.advantages = []
         self.paraphrases = [] # paraphrased question after applying action rules
+        self.paraphrase_lens = []
         self.pp_logits = [] # logits after paraphrasing
         self.pp_loss = []
         self.pp_optimize = []
         self.taken_actions = []
         self.action_probs = []
+        self.c_sims = []
+        self.sampled_actions = [] # in-graph rollouts
+        self.edit_distances = []
+        self.exploration_rate = tf.placeholder_with_default(0.0, [])
+        q_time = None if params['bucket_batch'] else params['question_maxlen']
         for _ in range(self.num_paraphrase):
             self.advantages.append(tf.placeholder(tf.float32, [None]))
-            self.taken_actions.append(tf.placeholder(tf.int32, 
-                [None, params['question_maxlen']]))
-            self.paraphrases.append(tf.placeholder(tf.int32, 
-                [None, params['question_maxlen']]))
+            self.taken_actions.append(tf.placeholder(tf.int32, [None, q_time]))
         super(QL_MPCM, self).__init__(params, initializer)
 
     def similarity_layer(self, context, question, context_rep, reuse=None):
@@ -50,10 +62,8 @@ class QL_MPCM(MPCM):
                     initializer=tf.eye(sim_mat_dim), dtype=tf.float32)
             # sim_mat = tf.get_variable('sim_mat', [sim_mat_dim, sim_mat_dim],
             #         initializer=tf.random_normal_initializer(), dtype=tf.float32)
-            b_sim_mat = tf.scan(lambda a, x: tf.identity(sim_mat), 
-                    context, tf.zeros([sim_mat_dim, sim_mat_dim], 
-                    dtype=tf.float32)) 
-            tmp_cont_sim = tf.matmul(n_context, b_sim_mat)
+            # [B, C, D] X [D, D] => [B, C, D] as one shared-matrix matmul
+            tmp_cont_sim = tf.tensordot(n_context, sim_mat, axes=1)
             similarity = tf.transpose(tf.matmul(tmp_cont_sim, tr_question), [0, 2, 1])
             self.c_sim = tf.argmax(similarity, axis=2)
             # self.c_sim = tf.reshape(tf.multinomial(
@@ -61,9 +71,11 @@ class QL_MPCM(MPCM):
             #             [-1, self.context_maxlen]), 1), [-1, self.question_maxlen])
         
         if self.policy_c == 'e':
-            selected_context = tf.scan(lambda a, x: tf.gather(x[0], x[1]),
-                    (self.context, self.c_sim), 
-                    tf.zeros([self.question_maxlen], dtype=tf.int32))
+            # Gather context word ids of every example at once: [B, Q]
+            batch_offset = tf.expand_dims(
+                    tf.range(tf.shape(self.context)[0]) * self.context_dim, -1)
+            selected_context = tf.gather(tf.reshape(self.context, [-1]),
+                    tf.cast(self.c_sim, tf.int32) + batch_offset)
             candidate = dropout(embedding_lookup(
                     inputs=selected_context,
                     voca_size=self.voca_size,
@@ -100,16 +112,13 @@ class QL_MPCM(MPCM):
             if candidate is not None:
                 c_fb = tf.concat(axis=1, values=[c_state[0][0][1], c_state[1][0][1]])
                 c_fb = tf.tile(tf.expand_dims(c_fb, axis=1),
-                        [1, self.question_maxlen, 1])
+                        [1, self.question_dim, 1])
                 # question = tf.concat(axis=2, values=[question, candidate, c_fb])
                 question = tf.concat(axis=2, values=[question, candidate])
             
             # Bidirectional
-            fw_cell = lstm_cell(
-                    self.pp_dim_rnn_cell, self.pp_rnn_layer, self.rnn_dropout)
-            bw_cell = lstm_cell(
-                    self.pp_dim_rnn_cell, self.pp_rnn_layer, self.rnn_dropout)
-            outputs, state = bi_rnn_model(question, length, fw_cell, bw_cell)
+            outputs, state = self.bi_rnn_layer(question, length,
+                    self.pp_dim_rnn_cell, self.pp_rnn_layer)
             #        c_state[0], c_state[1])
             
             outputs_t = tf.reshape(outputs, [-1, self.pp_dim_rnn_cell * 2])
@@ -118,23 +127,99 @@ class QL_MPCM(MPCM):
 
             action_sample = tf.multinomial(
                     tf.reshape(action_logit, [-1, self.dim_action]), 1)
-            action_sample = tf.reshape(action_sample, 
-                    [-1, self.question_maxlen, self.dim_action])
+            action_sample = tf.cast(tf.reshape(action_sample, 
+                    [-1, self.question_dim]), tf.int32)
+
+            # Uniform random actions with exploration_rate
+            explore = tf.less(tf.random_uniform(tf.shape(action_sample)),
+                    self.exploration_rate)
+            random_action = tf.random_uniform(tf.shape(action_sample),
+                    maxval=self.dim_action, dtype=tf.int32)
+            action_sample = tf.where(explore, random_action, action_sample)
             return action_sample, action_logit
 
-    def optimize_pp(self, action_logit, paraphrase_cnt):
+    def paraphrase_rules(self, question, length, action, action_prob, c_sim):
+        # In-graph counterpart of utils.paraphrase_batch
+        with tf.variable_scope('Paraphrase_Rules') as scope:
+            batch_size = tf.shape(question)[0]
+            q_len = tf.shape(question)[1]
+            c_len = tf.shape(self.context)[1]
+
+            # Positions the rules reach and actions within max_action
+            active = tf.sequence_mask(tf.maximum(length, 1), q_len)
+            if self.max_action > 0:
+                batch_index = tf.stack([tf.tile(tf.expand_dims(
+                    tf.range(batch_size), 1), [1, q_len]),
+                    tf.tile(tf.expand_dims(tf.range(q_len), 0), [batch_size, 1]),
+                    action], 2)
+                valid_probs = tf.gather_nd(action_prob, batch_index) * tf.cast(
+                        action > 0, tf.float64)
+                _, max_actions = tf.nn.top_k(valid_probs, 
+                        tf.minimum(self.max_action, q_len))
+                allowed = tf.reduce_any(tf.equal(tf.expand_dims(max_actions, 1),
+                    tf.reshape(tf.range(q_len), [1, -1, 1])), 2)
+                action = tf.where(allowed, action, tf.zeros_like(action))
+
+            # [B, Q, 4] question word and context words at c_sim + 0, 1, 2
+            c_offset = tf.expand_dims(tf.range(batch_size) * c_len, 1)
+            def context_word(shift):
+                return tf.gather(tf.reshape(self.context, [-1]),
+                        tf.minimum(c_sim + shift, c_len - 1) + c_offset)
+            words = tf.stack([question] + [context_word(s) for s in range(3)], 2)
+            word_valid = tf.stack([active, active,
+                tf.logical_and(active, c_sim < c_len - 1),
+                tf.logical_and(active, c_sim < c_len - 2)], 2)
+
+            # [B, Q, 4 slots, 4 words] rule selection
+            rule = tf.one_hot(tf.gather(tf.constant(PARAPHRASE_RULES), action),
+                    4, dtype=tf.int32)
+            tokens = tf.reduce_sum(rule * tf.expand_dims(words, 2), 3)
+            valid = tf.reduce_any(tf.logical_and(tf.cast(rule, tf.bool),
+                tf.expand_dims(word_valid, 2)), 3)
+
+            # Keep the first q_len emitted tokens in order and pad the rest
+            tokens = tf.reshape(tokens, [batch_size, -1])
+            valid = tf.reshape(valid, [batch_size, -1])
+            slot_index = tf.tile(tf.expand_dims(tf.range(q_len * 4), 0), 
+                    [batch_size, 1])
+            _, order = tf.nn.top_k(-tf.where(valid, slot_index, 
+                slot_index + q_len * 4), q_len)
+            paraphrased = tf.gather(tf.reshape(tokens, [-1]), 
+                    order + tf.expand_dims(tf.range(batch_size) * q_len * 4, 1))
+            new_length = tf.minimum(
+                    tf.reduce_sum(tf.cast(valid, tf.int32), 1), q_len)
+            paraphrased = tf.where(tf.sequence_mask(new_length, q_len),
+                    paraphrased, tf.ones_like(paraphrased)) # PAD token
+            edit_distance = tf.reduce_sum(tf.gather(
+                tf.constant(PARAPHRASE_EDITS), action) * tf.cast(active, tf.int32), 1)
+            return paraphrased, new_length, edit_distance
+
+    def optimize_pp(self, action_logit, taken_action, advantage, action_mask):
         print("# Calculating Paraphrased Loss\n")
-        advantage = self.advantages[paraphrase_cnt]
-        taken_action = self.taken_actions[paraphrase_cnt]
+
+        # Truncated importance weights for replayed actions; on-policy
+        # updates leave behavior_probs unfed, which gives weights of one
+        taken_prob = tf.reduce_sum(tf.nn.softmax(action_logit) * tf.one_hot(
+            taken_action, self.dim_action), 2)
+        behavior_prob = tf.placeholder_with_default(
+                tf.stop_gradient(taken_prob), [None, None])
+        self.behavior_probs.append(behavior_prob)
+        importance = tf.stop_gradient(tf.minimum(
+            taken_prob / tf.maximum(behavior_prob, 1e-8), self.replay_clip))
 
         # Add regularizer maybe (reg_loss)
-        pg_loss = tf.contrib.seq2seq.sequence_loss(
+        token_loss = tf.contrib.seq2seq.sequence_loss(
                 logits=action_logit,
                 targets=taken_action,
-                weights=self.question_mask,
+                weights=action_mask,
+                average_across_timesteps=False,
                 average_across_batch=False)
-        tf.summary.scalar('policy loss', tf.reduce_mean(pg_loss))
-        pg_loss *= advantage
+        pg_loss = tf.reduce_sum(token_loss, 1) / (
+                tf.reduce_sum(action_mask, 1) + 1e-12)
+        if self.params['summarize']:
+            tf.summary.scalar('policy loss', tf.reduce_mean(pg_loss))
+        pg_loss = tf.reduce_sum(token_loss * importance, 1) / (
+                tf.reduce_sum(action_mask, 1) + 1e-12) * advantage
        
         # Optimize only paraphrase params 
         self.policy_params = [p for p in tf.trainable_variables()
@@ -155,13 +240,63 @@ class QL_MPCM(MPCM):
         self.pp_optimize.append(optimize)
         self.pp_loss.append(total_loss)
         
-        for grad, var in self.policy_gradients:
-            tf.summary.histogram(var.name, var)
-            if grad is not None:
-                tf.summary.histogram(var.name + '/gradients', grad)
-        tf.summary.scalar('reg loss', reg_loss)
-        tf.summary.scalar('total loss', tf.reduce_mean(total_loss))
-        tf.summary.scalar('advantage', tf.reduce_mean(advantage))
+        if self.params['summarize']:
+            for grad, var in self.policy_gradients:
+                tf.summary.histogram(var.name, var)
+                if grad is not None:
+                    tf.summary.histogram(var.name + '/gradients', grad)
+            tf.summary.scalar('reg loss', reg_loss)
+            tf.summary.scalar('total loss', tf.reduce_mean(total_loss))
+            tf.summary.scalar('advantage', tf.reduce_mean(advantage))
+
+    def reader_layer(self, context_embed_input, question, question_len, 
+            char_question_embed, reuse=None, num_pass=1):
+        # Reader over num_pass question batches concatenated into one
+        # [num_pass * B] batch against the tiled context
+        def tile(x):
+            return tf.tile(x, [num_pass] + [1] * (len(x.get_shape()) - 1))
+
+        context_len, context_mask = self.context_len, self.context_mask
+        if num_pass > 1:
+            context_embed_input = tile(context_embed_input)
+            char_question_embed = tile(char_question_embed)
+            context_len, context_mask = tile(context_len), tile(context_mask)
+        question_embed = embedding_lookup(
+                inputs=question,
+                voca_size=self.voca_size,
+                embedding_dim=self.dim_embed_word,
+                initializer=self.initializer,
+                trainable=self.embed_trainable,
+                reuse=True, scope='Word')
+        
+        question_embed_input = dropout(tf.concat(
+            [question_embed, char_question_embed], 2), self.embed_dropout)
+
+        question_rep, _ = self.representation_layer(question_embed_input, 
+                question_len, self.question_maxlen, scope='Question', 
+                reuse=reuse)
+        
+        context_filtered = self.filter_layer(
+                context_embed_input, question_embed_input, reuse=reuse)
+        print('# Filter_layer', context_filtered)
+      
+        context_rep, c_state = self.representation_layer(context_filtered, 
+                context_len, self.context_maxlen, scope='Context', reuse=reuse)
+        print('# Representation_layer', context_rep, question_rep)
+
+        matchings = self.matching_layer(context_rep, question_rep, 
+                reuse=reuse, question_len=question_len)
+        print('# Matching_layer', matchings)
+
+        aggregates = self.aggregation_layer(matchings, self.context_maxlen,
+                context_len, reuse=reuse)
+        print('# Aggregation_layer', aggregates) 
+
+        sl, el = self.prediction_layer(aggregates, reuse=reuse,
+                context_mask=context_mask)
+        print('# Prediction_layer', sl, el)
+        return (sl, el, question_embed_input, question_rep, context_rep, 
+                c_state, question_len)
 
     def build_model(self):
         print("Question Learning Model")
@@ -182,79 +317,110 @@ class QL_MPCM(MPCM):
         context_embed_input = dropout(tf.concat(
             [context_embed, char_context_embed],2), self.embed_dropout)
 
-        for pp_idx in range(self.num_paraphrase + 1):
-            if pp_idx > 0: # Start paraphrase
-                # Similarity calculate
-                similarity_q = (question_embed_input if self.similarity_q == 'e'
-                        else question_rep)
-                similarity_c = (context_embed_input if self.similarity_c == 'e'
-                        else context_rep)
-                candidate = self.similarity_layer(similarity_c, 
-                        similarity_q, context_rep)
-
-                # Policy network for paraphrase
-                policy_q = (question_embed_input if self.policy_q == 'e'
-                        else question_rep)
-                _, action_logit = self.paraphrase_layer(
-                        policy_q, c_state,
-                        self.question_len, self.question_maxlen, 
-                        candidate=candidate, reuse=(pp_idx>1))
-                
-                # Return policy and receive sample
-                self.action_probs.append(tf.nn.softmax(
-                    tf.cast(action_logit, dtype=tf.float64)))
-                paraphrased = self.paraphrases[pp_idx-1]
-                print('# Paraphrase_layer %d' % (pp_idx), action_logit)
-
-            else: # No paraphrase (pp_idx = 0)
-                paraphrased = self.question
-            
-            question_embed = embedding_lookup(
-                    inputs=paraphrased,
-                    voca_size=self.voca_size,
-                    embedding_dim=self.dim_embed_word,
-                    initializer=self.initializer,
-                    trainable=self.embed_trainable,
-                    reuse=True, scope='Word')
-            
-            question_embed_input = dropout(tf.concat(
-                [question_embed, char_question_embed], 2), self.embed_dropout)
+        # The reader-only paths (training, eval, prediction, export) run
+        # just this first pass
+        passes = [self.reader_layer(context_embed_input, 
+            self.question, self.question_len, char_question_embed)]
+        self.start_logits, self.end_logits = passes[0][:2]
+        general_params = [p for p in tf.trainable_variables() 
+                if ('Paraphrase_Layer' not in p.name) and
+                ('Similarity_Layer' not in p.name)]
+        self.optimize_loss(
+                self.start_logits, self.end_logits, general_params)
 
-            question_rep, _ = self.representation_layer(question_embed_input, 
-                    self.question_len, self.question_maxlen,
-                    scope='Question', reuse=(pp_idx>0))
-            
-            context_filtered = self.filter_layer(
-                    context_embed_input, question_embed_input, 
-                    reuse=(pp_idx>0))
-            print('# Filter_layer', context_filtered)
-          
-            context_rep, c_state = self.representation_layer(context_filtered, 
-                    self.context_len,
-                    self.context_maxlen, scope='Context', reuse=(pp_idx>0))
-            print('# Representation_layer', context_rep, question_rep)
-
-            matchings = self.matching_layer(context_rep, 
-                    question_rep, reuse=(pp_idx>0))
-            print('# Matching_layer', matchings)
-
-            aggregates = self.aggregation_layer(matchings, self.context_maxlen,
-                    self.context_len, reuse=(pp_idx>0))
-            print('# Aggregation_layer', aggregates) 
-
-            sl, el= self.prediction_layer(aggregates, reuse=(pp_idx>0))
-            print('# Prediction_layer', sl, el)
-
-            if pp_idx > 0:
-                self.pp_logits.append([sl, el])
-                self.optimize_pp(action_logit, pp_idx-1)
-            else:
-                self.start_logits, self.end_logits = [sl, el]
-                general_params = [p for p in tf.trainable_variables() 
-                        if ('Paraphrase_Layer' not in p.name) and
-                        ('Similarity_Layer' not in p.name)]
-                self.optimize_loss(
-                        self.start_logits, self.end_logits, general_params)
+        if self.paraphrase_in_graph:
+            self.graph_paraphrases(context_embed_input, char_question_embed,
+                    passes)
+        else:
+            self.host_paraphrases(context_embed_input, char_question_embed,
+                    passes[0])
+
+    def policy_layer(self, reader_pass, context_embed_input, reuse=None):
+        # Paraphrase policy over the question of one reader pass
+        (_, _, question_embed_input, question_rep, context_rep, c_state,
+                question_len) = reader_pass
+
+        # Similarity calculate
+        similarity_q = (question_embed_input if self.similarity_q == 'e'
+                else question_rep)
+        similarity_c = (context_embed_input if self.similarity_c == 'e'
+                else context_rep)
+        candidate = self.similarity_layer(similarity_c, 
+                similarity_q, context_rep, reuse=reuse)
+        self.c_sims.append(self.c_sim)
+
+        # Policy network for paraphrase
+        policy_q = (question_embed_input if self.policy_q == 'e'
+                else question_rep)
+        action_sample, action_logit = self.paraphrase_layer(
+                policy_q, c_state,
+                question_len, self.question_dim, 
+                candidate=candidate, reuse=reuse)
+        
+        # Return policy and receive sample
+        self.action_probs.append(tf.nn.softmax(
+            tf.cast(action_logit, dtype=tf.float64)))
+        print('# Paraphrase_layer', action_logit)
+        return action_sample, action_logit
+
+    def host_paraphrases(self, context_embed_input, char_question_embed,
+            first_pass):
+        # Every rollout samples the policy of the original question, so the
+        # num_paraphrase host paraphrases are scored by one reader pass over
+        # a [P * B] batch and the policy is updated on all of them at once
+        num_pass = self.num_paraphrase
+        q_time = self.question.get_shape().as_list()[1]
+        _, action_logit = self.policy_layer(first_pass, context_embed_input)
+
+        # Unfed paraphrases default to the original question
+        for _ in range(num_pass):
+            self.paraphrases.append(tf.placeholder_with_default(
+                self.question, [None, q_time]))
+            self.paraphrase_lens.append(tf.placeholder_with_default(
+                self.question_len, [None]))
+        sl, el = self.reader_layer(context_embed_input, 
+                tf.concat(self.paraphrases, 0), 
+                tf.concat(self.paraphrase_lens, 0),
+                char_question_embed, reuse=True, num_pass=num_pass)[:2]
+        self.pp_logits = list(zip(tf.split(sl, num_pass), 
+            tf.split(el, num_pass)))
+
+        def tile(x):
+            return tf.tile(x, [num_pass] + [1] * (len(x.get_shape()) - 1))
+        self.optimize_pp(tile(action_logit), tf.concat(self.taken_actions, 0),
+                tf.concat(self.advantages, 0), tile(tf.sequence_mask(
+                    first_pass[-1], self.question_dim, dtype=tf.float32)))
+
+    def graph_paraphrases(self, context_embed_input, char_question_embed, 
+            passes):
+        # Each in-graph paraphrase rewrites the previous one, so every pass
+        # has its own reader call and policy update
+        q_time = self.question.get_shape().as_list()[1]
+        for pp_idx in range(1, self.num_paraphrase + 1):
+            question_len = passes[pp_idx-1][-1]
+            action_sample, action_logit = self.policy_layer(
+                    passes[pp_idx-1], context_embed_input, reuse=(pp_idx>1))
+
+            # Sampled paraphrases can be fed back for the policy update
+            question = ([self.question] + self.paraphrases)[pp_idx-1]
+            paraphrased, paraphrased_len, edit_distance = \
+                    self.paraphrase_rules(question, question_len, 
+                            action_sample, self.action_probs[-1], 
+                            tf.cast(self.c_sim, tf.int32))
+            self.sampled_actions.append(action_sample)
+            self.edit_distances.append(edit_distance)
+            self.paraphrases.append(tf.placeholder_with_default(
+                paraphrased, [None, q_time]))
+            self.paraphrase_lens.append(tf.placeholder_with_default(
+                paraphrased_len, [None]))
+            passes.append(self.reader_layer(context_embed_input,
+                self.paraphrases[-1], self.paraphrase_lens[-1],
+                char_question_embed, reuse=True))
+
+            self.pp_logits.append(passes[pp_idx][:2])
+            self.optimize_pp(action_logit, self.taken_actions[pp_idx-1],
+                    self.advantages[pp_idx-1], tf.sequence_mask(
+                        question_len, self.question_dim, dtype=tf.float32))
 
     def anneal_exploration(self):
         if self.exploration > 0:
@@ -1,36 +1,29 @@
+import sys
+import json
+import time
 import tensorflow as tf
 import numpy as np
 
 from evaluate import *
 from utils import *
-
-def run_paraphrase(question, question_len, context, context_len, 
-        context_raws, ground_truths, baseline_em, baseline_f1, lang_model, 
-        pp_idx, idx2word, model, feed_dict, params, is_train):
-
-    idx2action = { # 4=NDSI0, 6=NDSI1, 8=NDSI2, 11: NDSI2B
-            0: 'NONE',
-            1: 'DEL',
-            2: 'SUB0',
-            3: 'SUB1',
-            4: 'SUB2',
-            5: 'INS0F',
-            6: 'INS1F',
-            7: 'INS2F',
-            8: 'INS0B',
-            9: 'INS1B',
-            10: 'INS2B'
-    }
-    sess = model.session
-    action_prob, c_sim = sess.run(
-            [model.action_probs[pp_idx], model.c_sim],
-            feed_dict=feed_dict)
-
-    def softmax(logit):
-        logit = np.exp(logit - np.amax(logit))
-        logit = logit / np.sum(logit)
-        return logit
-
+from dataset import preprocess
+
+IDX2ACTION = { # 4=NDSI0, 6=NDSI1, 8=NDSI2, 11: NDSI2B
+        0: 'NONE',
+        1: 'DEL',
+        2: 'SUB0',
+        3: 'SUB1',
+        4: 'SUB2',
+        5: 'INS0F',
+        6: 'INS1F',
+        7: 'INS2F',
+        8: 'INS0B',
+        9: 'INS1B',
+        10: 'INS2B'
+}
+
+
+def sample_actions(action_prob, model):
     taken_action = []
     for batch_action in action_prob:
         actions = []
@@ -40,125 +33,16 @@ def run_paraphrase(question, question_len, context, context_len,
             else:
                 actions.append(np.argmax(np.random.multinomial(1, prob)))
         taken_action.append(actions)
+    return taken_action
 
-    def paraphrase_question(sentence, length, 
-            actions, actions_prob, c_s, c_org, max_a):
-        new_sentence = []
-        action_cnt = 0
-        itr = 0
-        edit_distance = 0
-
-        # Choose max actions that is not 'NONE'
-        valid_probs = np.array([a[idx] for a, idx in zip(actions_prob, actions)])
-        valid_probs *= np.array(actions).astype(bool)
-        max_actions = valid_probs.argsort()[-max_a:][::-1]
-        # dprint([(m, idx2action[actions[m]]) for m in max_actions], params['debug'])
-
-        for idx, act in enumerate(actions):
-            if (idx not in max_actions) and max_a > 0:
-                print('not here please')
-                new_sentence.append(sentence[itr])
-                itr += 1
-            elif idx2action[act] == 'NONE':
-                new_sentence.append(sentence[itr])
-                itr += 1
-            elif idx2action[act] == 'DEL':
-                itr += 1
-                edit_distance += 1
-            elif idx2action[act] == 'SUB0':
-                new_sentence.append(c_org[c_s[itr]])
-                itr += 1
-                edit_distance += 1
-            elif idx2action[act] == 'SUB1':
-                new_sentence.append(c_org[c_s[itr]])
-                if c_s[itr] < params['context_maxlen']-1:
-                    new_sentence.append(c_org[c_s[itr]+1])
-                itr += 1
-                edit_distance += 2
-            elif idx2action[act] == 'SUB2':
-                new_sentence.append(c_org[c_s[itr]])
-                if c_s[itr] < params['context_maxlen']-1:
-                    new_sentence.append(c_org[c_s[itr]+1])
-                if c_s[itr] < params['context_maxlen']-2:
-                    new_sentence.append(c_org[c_s[itr]+2])
-                itr += 1
-                edit_distance += 3
-            elif idx2action[act] == 'INS0F':
-                new_sentence.append(sentence[itr])
-                new_sentence.append(c_org[c_s[itr]])
-                itr += 1
-                edit_distance += 1
-            elif idx2action[act] == 'INS1F':
-                new_sentence.append(sentence[itr])
-                new_sentence.append(c_org[c_s[itr]])
-                if c_s[itr] < params['context_maxlen']-1:
-                    new_sentence.append(c_org[c_s[itr]+1])
-                itr += 1
-                edit_distance += 2
-            elif idx2action[act] == 'INS2F':
-                new_sentence.append(sentence[itr])
-                new_sentence.append(c_org[c_s[itr]])
-                if c_s[itr] < params['context_maxlen']-1:
-                    new_sentence.append(c_org[c_s[itr]+1])
-                if c_s[itr] < params['context_maxlen']-2:
-                    new_sentence.append(c_org[c_s[itr]+2])
-                itr += 1
-                edit_distance += 3
-            elif idx2action[act] == 'INS0B':
-                new_sentence.append(c_org[c_s[itr]])
-                new_sentence.append(sentence[itr])
-                itr += 1
-                edit_distance += 1
-            elif idx2action[act] == 'INS1B':
-                new_sentence.append(c_org[c_s[itr]])
-                if c_s[itr] < params['context_maxlen']-1:
-                    new_sentence.append(c_org[c_s[itr]+1])
-                new_sentence.append(sentence[itr])
-                itr += 1
-                edit_distance += 2
-            elif idx2action[act] == 'INS2B':
-                new_sentence.append(c_org[c_s[itr]])
-                if c_s[itr] < params['context_maxlen']-1:
-                    new_sentence.append(c_org[c_s[itr]+1])
-                if c_s[itr] < params['context_maxlen']-2:
-                    new_sentence.append(c_org[c_s[itr]+2])
-                new_sentence.append(sentence[itr])
-                itr += 1
-                edit_distance += 3
-            else:
-                assert False, 'Invalid action %d'% act
-
-            if itr >= length:
-                break
-       
-        new_length = len(new_sentence)
-        while len(new_sentence) <= len(sentence):
-            new_sentence.append(1) # PAD token
-        new_sentence = new_sentence[:model.question_maxlen]
-        new_length = (new_length if new_length < model.question_maxlen
-                else model.question_maxlen)
-
-        return new_sentence, new_length, edit_distance
-   
-    # Get paraphrased question according to the taken_action (batch unpack)
-    paraphrased_q = []
-    paraphrased_qlen = []
-    edit_distances = []
-    for org_q, org_q_len, action, a_prob, c_s, org_c in zip(
-            question, question_len, taken_action, action_prob, c_sim, context):
-        new_q, new_qlen, ed = paraphrase_question(
-                org_q, org_q_len, action, a_prob, c_s, org_c, model.max_action)
-        paraphrased_q.append(new_q)
-        paraphrased_qlen.append(new_qlen)
-        edit_distances.append(ed)
-
-    # Get scores for paraphrased question
-    feed_dict[model.paraphrases[pp_idx]] = np.array(paraphrased_q)
-    feed_dict[model.question_len] = np.array(paraphrased_qlen)
-    ps_logits, pe_logits = sess.run(model.pp_logits[pp_idx], feed_dict=feed_dict)
+
+def score_paraphrase(question, question_len, context, context_len, 
+        context_raws, ground_truths, baseline_em, baseline_f1, idx2word,
+        action_prob, c_sim, taken_action, paraphrased_q, paraphrased_qlen,
+        edit_distances, ps_logits, pe_logits, model, params, question_ids):
     predictions = pred_from_logits(ps_logits, pe_logits,
             context_len, context_raws, params)
-    em_s, f1_s = em_f1_score(predictions, ground_truths, params)
+    em_s, f1_s = em_f1_score(predictions, ground_truths, params, question_ids)
 
     dprint('\nparaphrased em %s' % em_s, params['debug'])
     dprint('baeline em %s' % baseline_em, params['debug'])
@@ -169,7 +53,7 @@ def run_paraphrase(question, question_len, context, context_len,
     dprint('max idx: %d, before em:%.3f, f1:%.3f // after em:%.3f, f1:%.3f' % (
         max_idx, baseline_em[max_idx], baseline_f1[max_idx], 
         em_s[max_idx], f1_s[max_idx]), params['debug'])
-    dprint('\nRules %s'% (' '.join([idx2action[idx]
+    dprint('\nRules %s'% (' '.join([IDX2ACTION[idx]
                 for idx in taken_action[max_idx][:question_len[max_idx]]])), 
                 params['debug'])
     dprint('Action prob %s'% [aa
@@ -218,19 +102,163 @@ def run_paraphrase(question, question_len, context, context_len,
         else:
             assert False, 'Invalid r, b'
 
+    return em_s, f1_s, rewards, baselines, advantages, smry_advs
+
+
+def update_policy(model, opt_idx, feed_dict, action_prob, taken_action,
+        rewards, baselines, advantages, params, is_train, summarize=False):
+    # feed_dict already holds the taken actions and advantages of opt_idx
+    sess = model.session
+    outputs = sess.run([
+        model.pp_optimize[opt_idx] if is_train else model.no_op,
+        model.pp_loss[opt_idx]] + ([model.merged_summary] if summarize else []),
+        feed_dict=feed_dict)
+    pp_loss = outputs[1]
+    summary = outputs[2] if summarize else None
+
+    # Extra off-policy updates from earlier rollouts
+    if is_train and params['replay_capacity'] > 0:
+        replay_buffer = model.replay_buffers[opt_idx]
+        taken_prob = np.take_along_axis(np.asarray(action_prob),
+                np.asarray(taken_action)[:, :, None], 2)[:, :, 0]
+        behavior_prob = ((1 - model.exploration) * taken_prob 
+                + model.exploration / model.dim_action)
+        replay_buffer.add(feed_dict, taken_action, behavior_prob,
+                rewards, baselines, advantages)
+        for entry in replay_buffer.sample(params['replay_ratio']):
+            replay_feed = dict(entry['feed_dict'])
+            replay_feed[model.behavior_probs[opt_idx]] = entry['behavior_prob']
+            sess.run(model.pp_optimize[opt_idx], feed_dict=replay_feed)
+
+    return pp_loss, summary
+
+
+def run_paraphrase(question, question_len, context, context_len, 
+        context_raws, ground_truths, baseline_em, baseline_f1, lang_model, 
+        pp_idx, idx2word, model, feed_dict, params, is_train, 
+        question_ids=None, summarize=False):
+    # One in-graph paraphrase pass: sample, paraphrase and score the rollout
+    # in a single call, then update the policy of this pass
+    sess = model.session
+    feed_dict[model.exploration_rate] = model.exploration
+    (action_prob, c_sim, taken_action, paraphrased_q, paraphrased_qlen,
+            edit_distances, (ps_logits, pe_logits)) = sess.run(
+            [model.action_probs[pp_idx], model.c_sims[pp_idx],
+                model.sampled_actions[pp_idx], model.paraphrases[pp_idx], 
+                model.paraphrase_lens[pp_idx], model.edit_distances[pp_idx],
+                model.pp_logits[pp_idx]], feed_dict=feed_dict)
+    feed_dict[model.paraphrases[pp_idx]] = paraphrased_q
+    feed_dict[model.paraphrase_lens[pp_idx]] = paraphrased_qlen
+
+    em_s, f1_s, rewards, baselines, advantages, smry_advs = score_paraphrase(
+            question, question_len, context, context_len, context_raws,
+            ground_truths, baseline_em, baseline_f1, idx2word,
+            action_prob, c_sim, taken_action, paraphrased_q, paraphrased_qlen,
+            edit_distances, ps_logits, pe_logits, model, params, question_ids)
+
     feed_dict[model.taken_actions[pp_idx]] = taken_action
     feed_dict[model.advantages[pp_idx]] = advantages
-    _, pp_loss, summary = sess.run([
-        model.pp_optimize[pp_idx] if is_train else model.no_op,
-        model.pp_loss[pp_idx], model.merged_summary], feed_dict=feed_dict)
+    pp_loss, summary = update_policy(model, pp_idx, feed_dict, action_prob,
+            taken_action, rewards, baselines, advantages, params, is_train,
+            summarize)
 
-    advantages = np.mean(smry_advs)
-    rewards = np.mean(rewards)
-    baselines = np.mean(baselines)
-    pp_em = np.sum(em_s) / len(question)
-    pp_f1 = np.sum(f1_s) / len(question)
+    return (np.sum(em_s) / len(question), np.sum(f1_s) / len(question), 
+            pp_loss, np.mean(smry_advs), np.mean(rewards), np.mean(baselines),
+            summary)
 
-    return pp_em, pp_f1, pp_loss, advantages, rewards, baselines, summary
+
+def run_paraphrases(question, question_len, context, context_len, 
+        context_raws, ground_truths, baseline_em, baseline_f1, lang_model, 
+        idx2word, model, feed_dict, params, is_train, 
+        question_ids=None, policy=None, summarize=False):
+    # Host paraphrases: every rollout samples the policy of the original
+    # question, all of them are scored by one reader call and the policy is
+    # updated on all of them at once
+    sess = model.session
+    if policy is None:
+        policy = sess.run([model.action_probs[0], model.c_sims[0]],
+                feed_dict=feed_dict)
+    action_prob, c_sim = policy
+
+    rollouts = []
+    for pp_idx in range(params['num_paraphrase']):
+        taken_action = sample_actions(action_prob, model)
+
+        # Get paraphrased question according to the taken_action
+        paraphrased_q, paraphrased_qlen, edit_distances = paraphrase_batch(
+                question, question_len, taken_action, action_prob, c_sim,
+                context, model.max_action)
+        feed_dict[model.paraphrases[pp_idx]] = paraphrased_q
+        feed_dict[model.paraphrase_lens[pp_idx]] = paraphrased_qlen
+        rollouts.append((taken_action, paraphrased_q, paraphrased_qlen,
+            edit_distances))
+
+    # Get scores for all paraphrased questions
+    pp_logits = sess.run(model.pp_logits, feed_dict=feed_dict)
+
+    results = []
+    scores = []
+    for pp_idx, (rollout, (ps_logits, pe_logits)) in enumerate(
+            zip(rollouts, pp_logits)):
+        taken_action, paraphrased_q, paraphrased_qlen, edit_distances = rollout
+        em_s, f1_s, rewards, baselines, advantages, smry_advs = \
+                score_paraphrase(
+                        question, question_len, context, context_len,
+                        context_raws, ground_truths, baseline_em, baseline_f1,
+                        idx2word, action_prob, c_sim, taken_action,
+                        paraphrased_q, paraphrased_qlen, edit_distances,
+                        ps_logits, pe_logits, model, params, question_ids)
+        feed_dict[model.taken_actions[pp_idx]] = taken_action
+        feed_dict[model.advantages[pp_idx]] = advantages
+        scores.append((taken_action, rewards, baselines, advantages))
+        results.append([np.sum(em_s) / len(question), 
+            np.sum(f1_s) / len(question), np.mean(smry_advs), 
+            np.mean(rewards), np.mean(baselines)])
+
+    taken_action, rewards, baselines, advantages = [
+            np.concatenate(s) for s in zip(*scores)]
+    pp_loss, summary = update_policy(model, 0, feed_dict, 
+            np.concatenate([action_prob] * len(rollouts)), taken_action,
+            rewards, baselines, advantages, params, is_train, summarize)
+
+    return [(em, f1, pp_loss, adv, reward, baseline) 
+            for em, f1, adv, reward, baseline in results], summary
+
+
+def build_feed_dict(model, batch, params, is_train):
+    # No dropout for question learning
+    if params['mode'] == 'q':
+        params['rnn_dropout'] = 1.0
+        params['hidden_dropout'] = 1.0
+        params['embed_dropout'] = 1.0
+        params['cnn_keep_prob'] = 1.0
+
+    feed_dict = {model.context: batch['c'],
+            model.context_len: batch['c_len'],
+            model.question: batch['q'],
+            model.question_len: batch['q_len'],
+            model.answer_start: batch['a_start'],
+            model.answer_end: batch['a_end'],
+            model.rnn_dropout: params['rnn_dropout'],
+            model.hidden_dropout: params['hidden_dropout'],
+            model.embed_dropout: params['embed_dropout'],
+            model.learning_rate: params['learning_rate'],
+            model.context_char: batch['c_char'],
+            model.question_char : batch['q_char'],
+            model.cnn_keep_prob : params['cnn_keep_prob']}
+    if params['char_table']:
+        feed_dict[model.char_table] = batch['char_table']
+    
+    # Use 1.0 dropout for test time
+    if not is_train:
+        feed_dict[model.rnn_dropout] = 1.0
+        feed_dict[model.hidden_dropout] = 1.0
+        feed_dict[model.embed_dropout] = 1.0
+        feed_dict[model.cnn_keep_prob] = 1.0
+    
+    if params['mode'] == 'bidaf':
+        feed_dict[model.is_train] = is_train
+    return feed_dict
 
 
 def run_epoch(model, dataset, epoch, base_iter, idx2word, params, 
@@ -238,10 +266,6 @@ def run_epoch(model, dataset, epoch, base_iter, idx2word, params,
     print('### Training ###' if is_train else '\n### Testing ###')
     sess = model.session
     batch_size = params['batch_size']
-    mini_batch = []
-    ground_truths = []
-    context_raws = []
-    question_raws = []  # Not used 
     total_loss = total_f1 = total_em = total_cnt = 0
     pp_em = [0] * params['num_paraphrase']
     pp_f1 = [0] * params['num_paraphrase']
@@ -251,156 +275,141 @@ def run_epoch(model, dataset, epoch, base_iter, idx2word, params,
     pp_advantage = [0] * params['num_paraphrase']
     pp_cnt = 0
 
-    for dataset_idx, dataset_item in enumerate(dataset):
-        context = dataset_item['c']
-        context_raw = dataset_item['c_raw']
-        context_len = dataset_item['c_len']
-        c_char_raw = dataset_item['c_char']
-        c_char = dataset_item['c_char_idx']
-        c_char_len = dataset_item['char_len']
-
-
-        for qa_idx, qa in enumerate(dataset_item['qa']):
-            question = qa['q']
-            question_len = qa['q_len']
-            question_raw = qa['q_raw']
-            answer = qa['a']
-            answer_start = qa['a_start']
-            answer_end = qa['a_end']
+    if params['bucket_batch']:
+        batches = dataset.bucket_batches(
+                batch_size, char_table=params['char_table'])
+    else:
+        batches = dataset.batches(batch_size, char_table=params['char_table'])
+
+    # Baselines of a frozen reader are reused across epochs
+    optimize = (model.optimize if not (params['mode'] == 'q' 
+        and params['train_pp_only']) and is_train else model.no_op)
+    baseline_cache = None
+    if (params['mode'] == 'q' and params['cache_baseline'] 
+            and optimize is model.no_op):
+        baseline_cache = model.baseline_cache
+        baseline_cache.validate(sess.run(model.variables_fingerprint))
+
+    # Batches and their feed dicts are assembled ahead of sess.run
+    batches = prefetch(((batch, build_feed_dict(model, batch, params, is_train))
+        for batch in batches), params['prefetch'])
+
+    for batch_idx, (batch, feed_dict) in enumerate(batches):
+        batch_context = batch['c']
+        batch_context_len = batch['c_len']
+        batch_question = batch['q']
+        batch_question_len = batch['q_len']
+        ground_truths = batch['answers']
+        context_raws = batch['c_raw']
+
+        cached = (baseline_cache.get(batch['ids']) 
+                if baseline_cache is not None else None)
+        policy = []
+        if cached is not None:
+            em, f1, losses = cached
+            loss = np.mean(losses)
+        else:
+            # The first paraphrase policy only reads the original question,
+            # so it shares this forward pass unless the reader is updated
+            policy_fetch = ([model.action_probs[0], model.c_sims[0]]
+                    if params['mode'] == 'q' and optimize is model.no_op
+                    and not params['paraphrase_in_graph'] else [])
+            loss_fetch = ([model.example_loss] 
+                    if baseline_cache is not None else [])
+            outputs = sess.run(
+                    [model.loss, model.start_logits, model.end_logits, 
+                        model.learning_rate, optimize] + loss_fetch 
+                    + policy_fetch, feed_dict=feed_dict)
+            loss, start_logits, end_logits, lr, _ = outputs[:5]
+            policy = outputs[5 + len(loss_fetch):]
             
-            q_char_raw = qa['q_char']
-            q_char = qa['q_char_idx']
-            q_char_len = qa['q_char_len']
-
-            mini_batch.append([context, context_len, 
-                question, question_len, answer_start, 
-                answer_end, c_char, c_char_len, q_char, q_char_len])
-            ground_truths.append(answer)
-            context_raws.append(context_raw)
-            question_raws.append(question_raw)
-           
-            # Run and clear mini-batch
-            if (len(mini_batch) == batch_size) or ((dataset_idx == len(dataset) - 1) 
-                    and (qa_idx == len(dataset_item['qa']) - 1)):
-                batch_context = np.array([b[0] for b in mini_batch])
-                batch_context_len = np.array([b[1] for b in mini_batch])
-                batch_question = np.array([b[2] for b in mini_batch])
-                batch_question_len = np.array([b[3] for b in mini_batch])
-                batch_answer_start = np.array([b[4] for b in mini_batch])
-                batch_answer_end = np.array([b[5] for b in mini_batch])
-                batch_context_char = np.array([b[6] for b in mini_batch])
-                batch_context_char_len = np.array([b[7] for b in mini_batch])
-                batch_question_char = np.array([b[8] for b in mini_batch])
-                batch_question_char_len = np.array([b[9] for b in mini_batch])
-
-                # No dropout for question learning
-                if params['mode'] == 'q':
-                    params['rnn_dropout'] = 1.0
-                    params['hidden_dropout'] = 1.0
-                    params['embed_dropout'] = 1.0
-
-                feed_dict = {model.context: batch_context,
-                        model.context_len: batch_context_len,
-                        model.question: batch_question,
-                        model.question_len: batch_question_len,
-                        model.answer_start: batch_answer_start,
-                        model.answer_end: batch_answer_end,
-                        model.rnn_dropout: params['rnn_dropout'],
-                        model.hidden_dropout: params['hidden_dropout'],
-                        model.embed_dropout: params['embed_dropout'],
-                        model.learning_rate: params['learning_rate'],
-                        model.context_char: batch_context_char,
-                        model.question_char : batch_question_char,
-                        model.cnn_keep_prob : params['cnn_keep_prob']}
-                
-                # Use 1.0 dropout for test time
-                if not is_train:
-                    feed_dict[model.rnn_dropout] = 1.0
-                    feed_dict[model.hidden_dropout] = 1.0
-                    feed_dict[model.embed_dropout] = 1.0
-                    feed_dict[model.cnn_keep_prob] = 1.0
-                
-                if params['mode'] == 'bidaf':
-                    feed_dict[model.is_train] = is_train
-
-                loss, start_logits, end_logits, lr, _ = sess.run(
-                        [model.loss, model.start_logits, model.end_logits, 
-                            model.learning_rate,
-                            model.optimize if not (params['mode'] == 'q' 
-                                and params['train_pp_only'])
-                            and is_train else model.no_op], feed_dict=feed_dict)
-                
-                predictions = pred_from_logits(start_logits, 
-                        end_logits, batch_context_len, context_raws, params)
-                em, f1 = em_f1_score(predictions, ground_truths, params)
-
-                baseline_em = em
-                baseline_f1 = f1
-                if params['mode'] == 'q':
-                    for pp_idx in range(params['num_paraphrase']):
-                        tmp_em, tmp_f1, tmp_loss, adv, tmp_r, tmp_b, summary = \
-                                run_paraphrase(
-                                        batch_question, batch_question_len,
-                                        batch_context, batch_context_len,
-                                        context_raws, ground_truths, 
-                                        baseline_em, baseline_f1, lang_model,
-                                        pp_idx, idx2word,
-                                        model, feed_dict, params, is_train=is_train)
-                        pp_em[pp_idx] += tmp_em
-                        pp_f1[pp_idx] += tmp_f1
-                        pp_losses[pp_idx] += tmp_loss
-                        pp_reward[pp_idx] += tmp_r
-                        pp_baseline[pp_idx] += tmp_b
-                        pp_advantage[pp_idx] += adv
-                        pp_cnt += 1
-                
-                # Print intermediate result
-                if dataset_idx % 5 == 0:
-                    em = np.sum(em) / len(mini_batch)
-                    f1 = np.sum(f1) / len(mini_batch)
-
-                    if params['summarize'] and params['mode'] == 'q':
-                        # Basic summary
-                        summary_writer = (model.train_writer if is_train
-                                else model.valid_writer)
-                        summary_writer.add_summary(
-                                summary, base_iter + pp_cnt)
-
-                        # Cumulative summary
-                        write_scalar_summary(
-                                'cumulative reward',
-                                pp_reward[0]/pp_cnt,
-                                base_iter + pp_cnt,
-                                summary_writer)
-                        write_scalar_summary(
-                                'cumulative baseline',
-                                pp_baseline[0]/pp_cnt,
-                                base_iter + pp_cnt,
-                                summary_writer)
-                        write_scalar_summary(
-                                'cumulative advantage',
-                                pp_advantage[0]/pp_cnt,
-                                base_iter + pp_cnt,
-                                summary_writer)
-
-                    _progress = progress(dataset_idx / float(len(dataset)))
-                    _progress += "loss:%.3f, em:%.3f, f1:%.3f" % (loss, em, f1)
-                    _progress += ", idx:%d/%d [e%d]" %(
-                            dataset_idx, len(dataset), epoch)
-                    if params['mode'] == 'q':
-                        _progress += " adv:%.3f" % (pp_advantage[0]/pp_cnt)
-                    sys.stdout.write(_progress)
-                    sys.stdout.flush()
-                    
-                    total_f1 += f1
-                    total_em += em
-                    total_loss += loss
-                    total_cnt += 1
-                    
-                mini_batch = []
-                ground_truths = []
-                context_raws = []
-                question_raws = []
+            predictions = pred_from_logits(start_logits, 
+                    end_logits, batch_context_len, context_raws, params)
+            em, f1 = em_f1_score(predictions, ground_truths, params, batch['ids'])
+            if baseline_cache is not None:
+                baseline_cache.update(batch['ids'], em, f1, outputs[5])
+
+        baseline_em = em
+        baseline_f1 = f1
+        summary = None
+        summarize = (params['summarize'] 
+                and batch_idx % params['summary_every'] == 0)
+        if params['mode'] == 'q' and params['paraphrase_in_graph']:
+            pp_results = []
+            for pp_idx in range(params['num_paraphrase']):
+                outputs = run_paraphrase(
+                        batch_question, batch_question_len,
+                        batch_context, batch_context_len,
+                        context_raws, ground_truths, 
+                        baseline_em, baseline_f1, lang_model,
+                        pp_idx, idx2word,
+                        model, feed_dict, params, is_train=is_train,
+                        question_ids=batch['ids'], summarize=summarize)
+                pp_results.append(outputs[:-1])
+                summary = outputs[-1]
+        elif params['mode'] == 'q':
+            pp_results, summary = run_paraphrases(
+                    batch_question, batch_question_len,
+                    batch_context, batch_context_len,
+                    context_raws, ground_truths, 
+                    baseline_em, baseline_f1, lang_model, idx2word,
+                    model, feed_dict, params, is_train=is_train,
+                    question_ids=batch['ids'], policy=policy or None,
+                    summarize=summarize)
+        if params['mode'] == 'q':
+            for pp_idx, (tmp_em, tmp_f1, tmp_loss, adv, tmp_r, tmp_b) in \
+                    enumerate(pp_results):
+                pp_em[pp_idx] += tmp_em
+                pp_f1[pp_idx] += tmp_f1
+                pp_losses[pp_idx] += tmp_loss
+                pp_reward[pp_idx] += tmp_r
+                pp_baseline[pp_idx] += tmp_b
+                pp_advantage[pp_idx] += adv
+                pp_cnt += 1
+        
+        if summary is not None:
+            # Basic summary
+            summary_writer = (model.train_writer if is_train
+                    else model.valid_writer)
+            summary_writer.add_summary(
+                    summary, base_iter + pp_cnt)
+
+            # Cumulative summary
+            write_scalar_summary(
+                    'cumulative reward',
+                    pp_reward[0]/pp_cnt,
+                    base_iter + pp_cnt,
+                    summary_writer)
+            write_scalar_summary(
+                    'cumulative baseline',
+                    pp_baseline[0]/pp_cnt,
+                    base_iter + pp_cnt,
+                    summary_writer)
+            write_scalar_summary(
+                    'cumulative advantage',
+                    pp_advantage[0]/pp_cnt,
+                    base_iter + pp_cnt,
+                    summary_writer)
+
+        # Print intermediate result
+        if batch_idx % 5 == 0:
+            em = np.sum(em) / len(ground_truths)
+            f1 = np.sum(f1) / len(ground_truths)
+
+            seen = min((batch_idx + 1) * batch_size, len(dataset))
+            _progress = progress(seen / float(len(dataset)))
+            _progress += "loss:%.3f, em:%.3f, f1:%.3f" % (loss, em, f1)
+            _progress += ", idx:%d/%d [e%d]" %(
+                    seen, len(dataset), epoch)
+            if params['mode'] == 'q':
+                _progress += " adv:%.3f" % (pp_advantage[0]/pp_cnt)
+            sys.stdout.write(_progress)
+            sys.stdout.flush()
+            
+            total_f1 += f1
+            total_em += em
+            total_loss += loss
+            total_cnt += 1
 
     # Average result
     total_em /= total_cnt
@@ -419,6 +428,78 @@ def run_epoch(model, dataset, epoch, base_iter, idx2word, params,
         print('Paraphrase loss: %.3f, em: %.3f, f1: %.3f, adv: %.3f' % (
             pp_losses[0], pp_em[0], pp_f1[0], pp_advantage[0]))
     print('Total iteration %d' % (pp_cnt + base_iter))
+    if params['summarize']:
+        (model.train_writer if is_train else model.valid_writer).flush()
 
     return total_em, total_f1, total_loss, pp_cnt + base_iter
 
+
+
+def predict_logits(model, feed_dict):
+    # Models with a context cache only encode unseen paragraphs
+    if getattr(model, 'context_cache', None) is not None:
+        return model.cached_logits(feed_dict)
+    return model.session.run([model.start_logits, model.end_logits],
+            feed_dict=feed_dict)
+
+
+def run_predict(model, articles, dictionary, char_dictionary, params):
+    # Streams articles through the model chunk by chunk and writes 
+    # {id: answer} to pred_path as the predictions come in
+    print('### Predicting ###')
+    batch_size = params['pred_batch_size']
+    chunk_size = params['pred_chunk']
+    total_cnt = skip_cnt = 0
+    start_time = time.time()
+
+    with open(params['pred_path'], 'w') as pred_file:
+        pred_file.write('{')
+        def write(qid, answer):
+            pred_file.write('%s\n%s: %s' % (',' if total_cnt + skip_cnt else '',
+                json.dumps(qid), json.dumps(answer)))
+
+        for chunk_idx in range(0, len(articles), chunk_size):
+            chunk = articles[chunk_idx:chunk_idx+chunk_size]
+            dataset = preprocess(chunk, dictionary, params['context_maxlen'],
+                    params['question_maxlen'], params['word_maxlen'],
+                    char_dictionary, params['preprocess_workers'])
+
+            # Empty paragraphs and questions and those over context_maxlen
+            # or question_maxlen are left unanswered
+            answered = set(dataset.ids)
+            for article in chunk:
+                for paragraph in article['paragraphs']:
+                    for qa in paragraph['qas']:
+                        if qa['id'] not in answered:
+                            write(qa['id'], '')
+                            skip_cnt += 1
+
+            batches = prefetch(((batch, build_feed_dict(
+                model, batch, params, is_train=False)) 
+                for batch in dataset.batches(batch_size, 
+                    char_table=params['char_table'])), params['prefetch'])
+            for batch, feed_dict in batches:
+                start_logits, end_logits = predict_logits(model, feed_dict)
+                predictions = pred_from_logits(start_logits, end_logits,
+                        batch['c_len'], batch['c_raw'], params)
+                for qid, answer in zip(batch['ids'], predictions):
+                    write(qid, answer)
+                    total_cnt += 1
+            
+            elapsed = time.time() - start_time
+            _progress = progress((chunk_idx + len(chunk)) / float(len(articles)))
+            _progress += "predicted:%d, skipped:%d, %.1f examples/sec" % (
+                    total_cnt, skip_cnt, total_cnt / max(elapsed, 1e-6))
+            sys.stdout.write(_progress)
+            sys.stdout.flush()
+
+        pred_file.write('\n}\n')
+
+    elapsed = time.time() - start_time
+    print('\nPredicted %d questions (%d skipped) in %.1fs, %.1f examples/sec' % (
+        total_cnt, skip_cnt, elapsed, total_cnt / max(elapsed, 1e-6)))
+    if getattr(model, 'context_cache', None) is not None:
+        print('Context cache hits:%d, misses:%d' % (
+            model.context_cache.hits, model.context_cache.misses))
+    print('Predictions written to %s' % params['pred_path'])
+    return total_cnt
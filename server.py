@@ -0,0 +1,217 @@
+import sys
+import json
+import time
+import queue
+import threading
+import socketserver
+import collections
+import numpy as np
+
+from http.server import BaseHTTPRequestHandler, HTTPServer
+from dataset import preprocess_articles, SquadDataset
+from run import build_feed_dict, predict_logits
+from utils import best_span
+
+
+class LatencyStats(object):
+    """Request latencies and batch sizes over the last window requests."""
+    def __init__(self, window=10000):
+        self.lock = threading.Lock()
+        self.latencies = collections.deque(maxlen=window)
+        self.batch_sizes = collections.deque(maxlen=window)
+        self.start_time = time.time()
+        self.count = 0
+
+    def add_latency(self, latency):
+        with self.lock:
+            self.latencies.append(latency)
+            self.count += 1
+
+    def add_batch(self, batch_size):
+        with self.lock:
+            self.batch_sizes.append(batch_size)
+
+    def summary(self):
+        with self.lock:
+            latencies = np.array(self.latencies) * 1000
+            batch_sizes = np.array(self.batch_sizes)
+            count = self.count
+        elapsed = time.time() - self.start_time
+        return {'requests': count,
+                'requests_per_sec': count / max(elapsed, 1e-6),
+                'p50_ms': float(np.percentile(latencies, 50)) if count else 0.0,
+                'p99_ms': float(np.percentile(latencies, 99)) if count else 0.0,
+                'mean_batch_size':
+                    float(np.mean(batch_sizes)) if len(batch_sizes) else 0.0}
+
+
+class MicroBatcher(object):
+    """Coalesces concurrent requests into batches for predict_fn.
+
+    A batch is run once it holds max_batch requests or max_wait seconds
+    after its first request arrived, whichever comes first.
+    """
+    def __init__(self, predict_fn, max_batch, max_wait, stats=None):
+        self.predict_fn = predict_fn
+        self.max_batch = max_batch
+        self.max_wait = max_wait
+        self.stats = stats
+        self.requests = queue.Queue()
+        self.thread = threading.Thread(target=self.run)
+        self.thread.daemon = True
+        self.thread.start()
+
+    def submit(self, item):
+        request = {'item': item, 'done': threading.Event(),
+                'result': None, 'error': None}
+        self.requests.put(request)
+        request['done'].wait()
+        if request['error'] is not None:
+            raise request['error']
+        return request['result']
+
+    def next_batch(self):
+        batch = [self.requests.get()]
+        deadline = time.time() + self.max_wait
+        while len(batch) < self.max_batch:
+            timeout = deadline - time.time()
+            if timeout <= 0:
+                break
+            try:
+                batch.append(self.requests.get(timeout=timeout))
+            except queue.Empty:
+                break
+        return batch
+
+    def run(self):
+        while True:
+            batch = self.next_batch()
+            if self.stats is not None:
+                self.stats.add_batch(len(batch))
+            try:
+                results = self.predict_fn([r['item'] for r in batch])
+                for request, result in zip(batch, results):
+                    request['result'] = result
+            except Exception as e:
+                for request in batch:
+                    request['error'] = e
+            finally:
+                for request in batch:
+                    request['done'].set()
+
+
+def predict_spans(model, items, dictionary, char_dictionary, params):
+    # Answers {context, question} items with their best spans and scores
+    paragraphs = [{'context': item['context'], 'qas': [{'id': str(idx),
+        'question': item['question'], 'answers': []}]}
+        for idx, item in enumerate(items)]
+    cqa_set, _ = preprocess_articles([{'paragraphs': paragraphs}], dictionary,
+            params['context_maxlen'], params['question_maxlen'])
+
+    # Items without tokens or over either limit are answered with the reason
+    results = [None] * len(items)
+    for idx, paragraph in enumerate(paragraphs):
+        if not paragraph['c_tokens']:
+            results[idx] = {'error': 'context is empty'}
+        elif not paragraph['qas'][0]['q_tokens']:
+            results[idx] = {'error': 'question is empty'}
+        elif len(paragraph['c_tokens']) > params['context_maxlen']:
+            results[idx] = {'error': 'context longer than %d tokens' %
+                    params['context_maxlen']}
+        elif len(paragraph['qas'][0]['q_tokens']) > params['question_maxlen']:
+            results[idx] = {'error': 'question longer than %d tokens' %
+                    params['question_maxlen']}
+    cqa_set = [item for item in cqa_set if item['qa']]
+    if not cqa_set:
+        return results
+
+    dataset = SquadDataset.from_items(cqa_set, char_dictionary,
+            params['word_maxlen'])
+    batch = dataset.batch(np.arange(len(dataset)),
+            char_table=params['char_table'], trim=params['bucket_batch'])
+    feed_dict = build_feed_dict(model, batch, params, is_train=False)
+    start_logits, end_logits = predict_logits(model, feed_dict)
+    start_idx, end_idx, scores = best_span(start_logits, end_logits,
+            batch['c_len'], params['max_answer_len'])
+
+    for qid, s_idx, e_idx, score in zip(batch['ids'], start_idx, end_idx, scores):
+        paragraph = paragraphs[int(qid)]
+        char_start = paragraph['c_starts'][s_idx]
+        char_end = paragraph['c_ends'][e_idx]
+        results[int(qid)] = {
+                'answer': paragraph['context'][char_start:char_end],
+                'start': int(char_start),
+                'end': int(char_end),
+                'score': float(score)}
+    return results
+
+
+class ThreadedHTTPServer(socketserver.ThreadingMixIn, HTTPServer):
+    daemon_threads = True
+    request_queue_size = 128
+
+
+def make_handler(batcher, stats):
+    class InferenceHandler(BaseHTTPRequestHandler):
+        def send_json(self, code, body):
+            data = json.dumps(body).encode('utf-8')
+            self.send_response(code)
+            self.send_header('Content-Type', 'application/json')
+            self.send_header('Content-Length', str(len(data)))
+            self.end_headers()
+            self.wfile.write(data)
+
+        def do_GET(self):
+            if self.path == '/metrics':
+                self.send_json(200, stats.summary())
+            else:
+                self.send_json(404, {'error': 'unknown path %s' % self.path})
+
+        def do_POST(self):
+            # {"context": ..., "question": ...} => {"answer", "start", "end", "score"}
+            if self.path != '/predict':
+                self.send_json(404, {'error': 'unknown path %s' % self.path})
+                return
+            start_time = time.time()
+            try:
+                length = int(self.headers.get('Content-Length', 0))
+                item = json.loads(self.rfile.read(length).decode('utf-8'))
+                item = {'context': str(item['context']),
+                        'question': str(item['question'])}
+            except (ValueError, KeyError, TypeError) as e:
+                self.send_json(400, {'error': 'bad request: %s' % e})
+                return
+            try:
+                result = batcher.submit(item)
+            except Exception as e:
+                stats.add_latency(time.time() - start_time)
+                self.send_json(500, {'error': '%s: %s' % (
+                    type(e).__name__, e)})
+                return
+            stats.add_latency(time.time() - start_time)
+            self.send_json(400 if 'error' in result else 200, result)
+
+        def log_message(self, format, *args):
+            pass
+
+    return InferenceHandler
+
+
+def serve(model, dictionary, char_dictionary, params):
+    stats = LatencyStats()
+    batcher = MicroBatcher(
+            lambda items: predict_spans(
+                model, items, dictionary, char_dictionary, params),
+            params['serve_batch'], params['serve_wait_ms'] / 1000.0, stats)
+    server = ThreadedHTTPServer((params['serve_host'], params['serve_port']),
+            make_handler(batcher, stats))
+    print('Serving %s on http://%s:%d (POST /predict, GET /metrics)' % (
+        params['model_name'], params['serve_host'], params['serve_port']))
+    sys.stdout.flush()
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.server_close()
+        print('Served', stats.summary())
@@ -1,6 +1,13 @@
 import sys
+import re
+import string
+import threading
+import queue
+import hashlib
 import numpy as np
 
+from collections import Counter, OrderedDict
+
 from tensorflow.core.framework import summary_pb2
 from evaluate import *
 
@@ -30,27 +37,124 @@ def dprint(msg, debug, end='\n'):
         print(msg, end=end)
 
 
-def em_f1_score(predictions, ground_truths, params):
-    em = []
-    f1 = []
-    for prediction, ground_truth in zip(predictions, ground_truths):
-        single_em = metric_max_over_ground_truths(
-                exact_match_score, prediction, ground_truth)
-        single_f1 = metric_max_over_ground_truths(
-                f1_score, prediction, ground_truth)
-        em.append(single_em)
-        f1.append(single_f1)
+# Same normalization as evaluate.normalize_answer, compiled once
+PUNCTUATION_TABLE = str.maketrans('', '', string.punctuation)
+ARTICLES_REGEX = re.compile(r'\b(a|an|the)\b')
+# LRU of normalized ground truths by question id; holds SQuAD train + dev
+GROUND_TRUTH_CACHE_SIZE = 100000
+ground_truth_cache = OrderedDict()
+
+
+def fast_normalize_answer(s):
+    return ' '.join(ARTICLES_REGEX.sub(
+        ' ', s.lower().translate(PUNCTUATION_TABLE)).split())
+
 
-    em = np.array(em).astype(int)
-    f1 = np.array(f1)
+def normalize_ground_truths(ground_truth, key=None):
+    # Normalized strings and token counters of a question's answers,
+    # cached per question key
+    if key is not None and key in ground_truth_cache:
+        ground_truth_cache.move_to_end(key)
+        return ground_truth_cache[key]
+    normalized = [fast_normalize_answer(answer) for answer in ground_truth]
+    result = (set(normalized), 
+            [(Counter(n.split()), len(n.split())) for n in normalized])
+    if key is not None:
+        ground_truth_cache[key] = result
+        if len(ground_truth_cache) > GROUND_TRUTH_CACHE_SIZE:
+            ground_truth_cache.popitem(last=False)
+    return result
+
+
+def em_f1_score(predictions, ground_truths, params, keys=None):
+    if keys is None:
+        keys = [None] * len(predictions)
+    em = np.zeros(len(predictions), dtype=int)
+    f1 = np.zeros(len(predictions))
+    for idx, (prediction, ground_truth, key) in enumerate(
+            zip(predictions, ground_truths, keys)):
+        exact, counters = normalize_ground_truths(ground_truth, key)
+        normalized = fast_normalize_answer(prediction)
+        em[idx] = normalized in exact
+        pred_tokens = normalized.split()
+        pred_counter = Counter(pred_tokens)
+        for gt_counter, gt_len in counters:
+            num_same = sum((pred_counter & gt_counter).values())
+            if num_same == 0:
+                continue
+            precision = 1.0 * num_same / len(pred_tokens)
+            recall = 1.0 * num_same / gt_len
+            f1[idx] = max(f1[idx], (2 * precision * recall) / (precision + recall))
     return em, f1
 
 
+def window_max(values, window):
+    """Max and argmax of values[:, i-window+1:i+1] for every position i.
+
+    Uses block-wise prefix/suffix maxima (van Herk/Gil-Werman), so the cost
+    is O(n) per row regardless of the window size.
+    """
+    batch_size, length = values.shape
+    block_cnt = -(-length // window)
+    padded = np.full([batch_size, block_cnt * window], -np.inf)
+    padded[:, :length] = values
+    blocks = padded.reshape(batch_size, block_cnt, window)
+    index = np.arange(block_cnt * window).reshape(1, block_cnt, window)
+
+    def running_max(b, i):
+        # Running max and the index of its latest achiever
+        b_max = np.maximum.accumulate(b, axis=2)
+        i_max = np.maximum.accumulate(
+                np.where(b == b_max, i, -index.size - 1), axis=2)
+        return b_max, i_max
+
+    prefix, prefix_idx = running_max(blocks, index)
+    # Suffixes run backwards, so indices are negated to keep the nearest one
+    suffix, suffix_idx = running_max(blocks[:, :, ::-1], -index[:, :, ::-1])
+    prefix = prefix.reshape(batch_size, -1)[:, :length]
+    prefix_idx = prefix_idx.reshape(batch_size, -1)[:, :length]
+    suffix = suffix[:, :, ::-1].reshape(batch_size, -1)
+    suffix_idx = -suffix_idx[:, :, ::-1].reshape(batch_size, -1)
+    
+    # Window [i-window+1, i] = suffix of its first block + prefix of its last
+    low = np.arange(length) - window + 1
+    low_suffix = np.where(low >= 0, suffix[:, np.maximum(low, 0)], -np.inf)
+    low_suffix_idx = suffix_idx[:, np.maximum(low, 0)]
+    use_suffix = low_suffix >= prefix
+    return (np.where(use_suffix, low_suffix, prefix),
+            np.where(use_suffix, low_suffix_idx, prefix_idx))
+
+
+def best_span(start_logits, end_logits, lengths, max_span=0):
+    """Jointly best (start, end) with start <= end < start + max_span.
+
+    Returns start and end indices and the log-probability of the span under
+    the start/end softmax over the first lengths positions. max_span <= 0
+    means no length limit.
+    """
+    start_logits = np.asarray(start_logits, dtype=np.float64)
+    end_logits = np.asarray(end_logits, dtype=np.float64)
+    batch_size, length = start_logits.shape
+    lengths = np.maximum(np.asarray(lengths), 1)
+    valid = np.arange(length)[None, :] < lengths[:, None]
+
+    def log_softmax(logits):
+        logits = np.where(valid, logits, -np.inf)
+        logits = logits - np.max(logits, axis=1, keepdims=True)
+        return logits - np.log(np.sum(np.exp(logits), axis=1, keepdims=True))
+
+    window = max_span if 0 < max_span < length else length
+    best_start, best_start_idx = window_max(log_softmax(start_logits), window)
+    scores = best_start + log_softmax(end_logits)
+    end_idx = np.argmax(scores, axis=1)
+    batch_idx = np.arange(batch_size)
+    return (best_start_idx[batch_idx, end_idx], end_idx, 
+            scores[batch_idx, end_idx])
+
+
 def pred_from_logits(start_logits, end_logits, batch_context_len, c_raws, params):
-    start_idx = [np.argmax(sl[:cl], 0) 
-            for sl, cl in zip(start_logits, batch_context_len)]
-    end_idx = [np.argmax(el[si:cl], 0) + si for el, si, cl in zip(
-        end_logits, start_idx, batch_context_len)]
+    start_idx, end_idx, _ = best_span(start_logits, end_logits, 
+            batch_context_len, params['max_answer_len'])
 
     predictions = []
     for c, s_idx, e_idx in zip(c_raws, start_idx, end_idx):
@@ -58,8 +162,250 @@ def pred_from_logits(start_logits, end_logits, batch_context_len, c_raws, params
 
     return predictions
 
+# Paraphrase rules by action id (NONE, DEL, SUB0-2, INS0-2F, INS0-2B).
+# Each rule emits up to four tokens taken from the question word (0) or the
+# most similar context word and the one or two words after it (1, 2, 3).
+PARAPHRASE_RULES = [
+        [0, -1, -1, -1],
+        [-1, -1, -1, -1],
+        [1, -1, -1, -1],
+        [1, 2, -1, -1],
+        [1, 2, 3, -1],
+        [0, 1, -1, -1],
+        [0, 1, 2, -1],
+        [0, 1, 2, 3],
+        [1, 0, -1, -1],
+        [1, 2, 0, -1],
+        [1, 2, 3, 0]]
+PARAPHRASE_EDITS = [0, 1, 1, 2, 3, 1, 2, 3, 1, 2, 3]
+
+
+def paraphrase_batch(questions, lengths, actions, action_probs, c_sim, contexts,
+        max_action=0):
+    """Applies the paraphrase rules to a whole batch of questions.
+    
+    Returns the paraphrased [B, Q] ids (PAD is 1), their lengths and the
+    edit distances, matching the token by token rewriting it replaced.
+    """
+    questions = np.asarray(questions)
+    actions = np.asarray(actions)
+    c_sim = np.asarray(c_sim)
+    contexts = np.asarray(contexts)
+    batch_size, q_len = questions.shape
+    c_len = contexts.shape[1]
+    rows = np.arange(batch_size)[:, None]
+
+    # The first position is always rewritten, even for empty questions
+    active = np.arange(q_len) < np.maximum(lengths, 1)[:, None]
+    if max_action > 0:
+        # Only the max_action most probable non-NONE actions apply
+        valid_probs = np.take_along_axis(np.asarray(action_probs), 
+                actions[:, :, None], 2)[:, :, 0] * actions.astype(bool)
+        max_actions = np.argsort(valid_probs, axis=1)[:, -max_action:]
+        allowed = np.zeros(actions.shape, dtype=bool)
+        allowed[rows, max_actions] = True
+        actions = np.where(allowed, actions, 0)
+
+    # [B, Q, 4] question word and context words at c_sim + 0, 1, 2
+    words = np.stack([questions] + [contexts[rows, np.minimum(c_sim + shift, 
+        c_len - 1)] for shift in range(3)], 2)
+    word_valid = np.stack([active, active, active & (c_sim < c_len - 1),
+        active & (c_sim < c_len - 2)], 2)
+    slots = np.asarray(PARAPHRASE_RULES)[actions]
+    tokens = np.take_along_axis(words, np.maximum(slots, 0), 2)
+    valid = (slots >= 0) & np.take_along_axis(word_valid, np.maximum(slots, 0), 2)
+
+    # Emitted tokens in order, truncated to Q
+    tokens = tokens.reshape(batch_size, -1)
+    valid = valid.reshape(batch_size, -1)
+    positions = np.cumsum(valid, 1) - 1
+    keep = valid & (positions < q_len)
+    paraphrased = np.ones_like(questions)
+    paraphrased[np.nonzero(keep)[0], positions[keep]] = tokens[keep]
+    new_lengths = np.minimum(valid.sum(1), q_len)
+    edit_distances = (np.asarray(PARAPHRASE_EDITS)[actions] * active).sum(1)
+    return paraphrased, new_lengths, edit_distances
+
+
+class BaselineCache(object):
+    """Per question em, f1 and loss of a frozen reader.
+
+    Entries are dropped whenever validate() sees a different fingerprint
+    of the reader weights.
+    """
+    def __init__(self):
+        self.fingerprint = None
+        self.scores = {}
+
+    def validate(self, fingerprint):
+        if (self.fingerprint is None 
+                or not np.array_equal(self.fingerprint, fingerprint)):
+            self.fingerprint = fingerprint
+            self.scores = {}
+
+    def get(self, keys):
+        if not all(key in self.scores for key in keys):
+            return None
+        em, f1, loss = zip(*[self.scores[key] for key in keys])
+        return np.array(em), np.array(f1), np.array(loss)
+
+    def update(self, keys, em, f1, loss):
+        for key, scores in zip(keys, zip(em, f1, loss)):
+            self.scores[key] = scores
+
+
+class ContextCache(object):
+    """LRU cache of question-independent context encodings.
+
+    Keys hash the word ids of a context up to its length, so the same
+    paragraph hits the cache however it was padded.
+    """
+    def __init__(self, capacity):
+        self.capacity = capacity
+        self.entries = OrderedDict()
+        self.hits = self.misses = 0
+
+    @staticmethod
+    def key(context, length):
+        return hashlib.sha1(
+                np.asarray(context[:length], dtype=np.int32).tobytes()).digest()
+
+    def get(self, key):
+        if key not in self.entries:
+            self.misses += 1
+            return None
+        self.hits += 1
+        self.entries.move_to_end(key)
+        return self.entries[key]
+
+    def put(self, key, encoding):
+        self.entries[key] = encoding
+        self.entries.move_to_end(key)
+        while len(self.entries) > self.capacity:
+            self.entries.popitem(last=False)
+
+
+class ReplayBuffer(object):
+    """Past paraphrase rollouts for off-policy policy updates.
+
+    Each entry keeps the feed of one batch with its taken actions, their
+    behavior probabilities, rewards, baselines and advantages. A full
+    buffer evicts the oldest entry (fifo), a random one (random) or the
+    one with the smallest mean absolute advantage (priority).
+    """
+    def __init__(self, capacity, eviction='fifo'):
+        assert eviction in ['fifo', 'random', 'priority'], \
+                'Wrong eviction %s' % eviction
+        self.capacity = capacity
+        self.eviction = eviction
+        self.entries = []
+
+    def __len__(self):
+        return len(self.entries)
+
+    def add(self, feed_dict, taken_action, behavior_prob, 
+            rewards, baselines, advantages):
+        if self.capacity <= 0:
+            return
+        if len(self.entries) >= self.capacity:
+            if self.eviction == 'fifo':
+                evict_idx = 0
+            elif self.eviction == 'random':
+                evict_idx = np.random.randint(len(self.entries))
+            else:
+                evict_idx = int(np.argmin([np.mean(np.abs(e['advantages']))
+                    for e in self.entries]))
+            del self.entries[evict_idx]
+        self.entries.append({'feed_dict': dict(feed_dict),
+            'taken_action': np.asarray(taken_action),
+            'behavior_prob': np.asarray(behavior_prob),
+            'rewards': np.asarray(rewards),
+            'baselines': np.asarray(baselines),
+            'advantages': np.asarray(advantages)})
+
+    def sample(self, replay_ratio):
+        # replay_ratio entries per call, the fraction taken at random
+        if not self.entries:
+            return []
+        num_sample = int(replay_ratio) + int(
+                np.random.random() < replay_ratio - int(replay_ratio))
+        return [self.entries[idx] 
+                for idx in np.random.randint(len(self.entries), size=num_sample)]
+
+
 def write_scalar_summary(name, value, iter, writer):
     value_to_write = summary_pb2.Summary.Value(tag=name, simple_value=value)
     summary = summary_pb2.Summary(value=[value_to_write])
     writer.add_summary(summary, iter)
 
+
+class BackgroundSummaryWriter(object):
+    """Hands summaries to a tf.summary.FileWriter from a daemon thread."""
+    def __init__(self, writer, max_queue=100):
+        self.writer = writer
+        self.queue = queue.Queue(max_queue)
+        self.thread = threading.Thread(target=self.write)
+        self.thread.daemon = True
+        self.thread.start()
+
+    def write(self):
+        while True:
+            summary, global_step = self.queue.get()
+            try:
+                self.writer.add_summary(summary, global_step)
+            finally:
+                self.queue.task_done()
+
+    def add_summary(self, summary, global_step=None):
+        self.queue.put((summary, global_step))
+
+    def flush(self):
+        self.queue.join()
+        self.writer.flush()
+
+
+def prefetch(iterable, buffer_size):
+    # Produce items of iterable in a background thread, keeping at most
+    # buffer_size of them ready; 0 runs it in the caller's thread
+    if buffer_size <= 0:
+        for item in iterable:
+            yield item
+        return
+
+    items = queue.Queue(maxsize=buffer_size)
+    stop = threading.Event()
+    end = object()
+
+    def put(entry):
+        # Gives up once the consumer has stopped, so a full queue never
+        # blocks the producer for good
+        while not stop.is_set():
+            try:
+                items.put(entry, timeout=0.1)
+                return True
+            except queue.Full:
+                pass
+        return False
+
+    def produce():
+        try:
+            for item in iterable:
+                if not put((item, None)):
+                    return
+            put((end, None))
+        except Exception as e:
+            put((end, e))
+
+    producer = threading.Thread(target=produce)
+    producer.daemon = True
+    producer.start()
+    try:
+        while True:
+            item, error = items.get()
+            if error is not None:
+                raise error
+            if item is end:
+                break
+            yield item
+    finally:
+        stop.set()